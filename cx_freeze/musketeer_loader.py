@@ -1 +1,6 @@
-from musketeer import __main__  # noqa: F401
+import multiprocessing
+
+# The worker processes of a global search run this executable again.
+multiprocessing.freeze_support()
+
+from musketeer import __main__  # noqa: E402, F401
@@ -25,6 +25,12 @@ class ContributingSpecies(moduleFrame.Strategy):
             return contributorConcs[self.signalToMoleculeMap, :, :]
 
     def run(self):
+        modelPlan = getattr(self.titration, "plan", None)
+        if (
+            modelPlan is not None
+            and modelPlan.contributors.contributingSpeciesSource is self
+        ):
+            return modelPlan.contributors.filter
         return self.filter
 
 
@@ -4,6 +4,7 @@ import tkinter.ttk as ttk
 import numpy as np
 
 from . import moduleFrame
+from .modelPlan import ContributorsPlan
 from .scrolledFrame import ScrolledFrame
 from .style import padding
 from .table import ButtonFrame, Table, WrappedLabel
@@ -20,10 +21,54 @@ class ContributorConcs(moduleFrame.Strategy):
         "contributorsCountPerMolecule",
     )
 
+    # The ContributorsPlan used outside of a fit isn't copied with the strategy, as it
+    # can be rebuilt.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("planCache", None)
+        return state
+
+    # Everything the ContributorsPlan is built from: the entered contributors and
+    # contributing species, and the speciation plan, which is replaced whenever the
+    # stoichiometries change.
+    def planSources(self):
+        contributingSpecies = self.titration.contributingSpecies
+        return (
+            contributingSpecies,
+            self.titration.speciation.plan,
+            *(getattr(self, name, None) for name in self.popupAttributes),
+            *(
+                getattr(contributingSpecies, name, None)
+                for name in contributingSpecies.popupAttributes
+            ),
+        )
+
+    # The frozen ContributorsPlan compiled by Titration.optimise(). Outside of a fit,
+    # one is built and reused until any of its sources change.
+    @property
+    def plan(self):
+        modelPlan = getattr(self.titration, "plan", None)
+        if modelPlan is not None and modelPlan.contributors.source is self:
+            return modelPlan.contributors
+        sources = self.planSources()
+        cache = getattr(self, "planCache", None)
+        if (
+            cache is None
+            or len(cache[0]) != len(sources)
+            or any(old is not new for old, new in zip(cache[0], sources))
+        ):
+            cache = (
+                sources,
+                ContributorsPlan(self, self.titration.contributingSpecies),
+            )
+            self.planCache = cache
+        return cache[1]
+
     def run(self, speciesConcs):
+        plan = self.plan
         return (
-            speciesConcs @ self.contributorsMatrix.T,
-            self.contributorsCountPerMolecule,
+            speciesConcs @ plan.contributorsMatrixT,
+            plan.contributorsCountPerMolecule,
         )
 
 
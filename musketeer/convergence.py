@@ -0,0 +1,129 @@
+import tkinter.ttk as ttk
+
+import numpy as np
+from numpy import ma
+
+from . import moduleFrame
+from .table import ButtonFrame, Table
+
+
+# When a fit is considered converged, and how much it may spend before returning the
+# best parameters found so far. NaN means the optimiser's default tolerance, or no
+# limit on the evaluations or time.
+class Convergence(moduleFrame.Strategy):
+    requiredAttributes = ()
+
+    logKTolerance = np.nan
+    logConcTolerance = np.nan
+    maxEvaluations = np.nan
+    maxTime = np.nan
+
+    # The absolute tolerance in log10 of each unknown K and total concentration, or
+    # None to use the optimiser's default.
+    def getTolerances(self):
+        if np.isnan(self.logKTolerance) and np.isnan(self.logConcTolerance):
+            return None
+        return np.concatenate(
+            [
+                np.full(
+                    self.titration.equilibriumConstants.variableCount,
+                    self.logKTolerance,
+                ),
+                np.full(
+                    self.titration.totalConcentrations.variableCount,
+                    self.logConcTolerance,
+                ),
+            ]
+        )
+
+
+class ConvergenceDefault(Convergence):
+    pass
+
+
+class ConvergenceTable(Table):
+    rowNames = (
+        "Tolerance in log₁₀ K",
+        "Tolerance in log₁₀ concentration",
+        "Maximum number of evaluations",
+        "Maximum time (s)",
+    )
+
+    def __init__(self, master, titration):
+        super().__init__(
+            master,
+            0,
+            0,
+            ("Value",),
+            maskBlanks=True,
+            rowOptions=("readonlyTitles",),
+            columnOptions=("readonlyTitles",),
+            boldTitles=True,
+            # empty rather than "?", as these are not variables to be optimised
+            blankValue="",
+        )
+        convergence = titration.convergence
+        for name, attribute in zip(self.rowNames, ConvergencePopup.attributes):
+            value = getattr(convergence, attribute, np.nan)
+            self.addRow(name, ["" if np.isnan(value) else value])
+
+
+class ConvergencePopup(moduleFrame.Popup):
+    attributes = ("logKTolerance", "logConcTolerance", "maxEvaluations", "maxTime")
+
+    def __init__(self, titration, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.titration = titration
+        self.title("Convergence criteria")
+
+        self.frame = ttk.Frame(self)
+        self.frame.pack(expand=True, fill="both")
+
+        convergenceLabel = ttk.Label(
+            self.frame,
+            text=(
+                "The fit stops once the Nelder-Mead simplex is smaller than the"
+                " tolerances,\nor returns the best parameters found so far once either"
+                " limit is reached.\nLeave cells blank for the optimiser's default"
+                " tolerance, or no limit."
+            ),
+        )
+        convergenceLabel.pack()
+
+        self.convergenceTable = ConvergenceTable(self.frame, titration)
+        self.convergenceTable.pack(expand=True, fill="both")
+
+        buttonFrame = ButtonFrame(self.frame, self.reset, self.saveData, self.destroy)
+        buttonFrame.pack(expand=False, fill="both", side="bottom")
+
+    def reset(self):
+        self.convergenceTable.data = np.full((len(self.attributes), 1), "")
+
+    def saveData(self):
+        values = ma.filled(self.convergenceTable.data, np.nan)[:, 0]
+        if np.any(values <= 0):
+            raise ValueError("The tolerances and limits must be positive.")
+        maxEvaluations = values[2]
+        if not np.isnan(maxEvaluations) and maxEvaluations != int(maxEvaluations):
+            raise ValueError("The maximum number of evaluations must be an integer.")
+
+        for attribute, value in zip(self.attributes, values):
+            setattr(self, attribute, value)
+
+        self.saved = True
+        self.destroy()
+
+
+class ConvergenceCustom(Convergence):
+    Popup = ConvergencePopup
+    popupAttributes = ConvergencePopup.attributes
+
+
+class ModuleFrame(moduleFrame.ModuleFrame):
+    group = "Fitting"
+    dropdownLabelText = "Convergence criteria:"
+    dropdownOptions = {
+        "Optimiser defaults": ConvergenceDefault,
+        "Custom tolerances and limits": ConvergenceCustom,
+    }
+    attributeName = "convergence"
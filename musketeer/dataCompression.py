@@ -0,0 +1,211 @@
+import tkinter.ttk as ttk
+from abc import abstractmethod
+
+import numpy as np
+from numpy import ma
+
+from . import moduleFrame
+from .fitSignals import FitSignalsUnconstrained
+from .modelPlan import FrozenPlan, freeze
+from .table import ButtonFrame, Table
+
+
+# Fraction of the total variance of the data that is discarded by truncating it to
+# each rank, starting from rank 0.
+def discardedVarianceFractions(singularValues):
+    variances = singularValues**2
+    total = np.sum(variances)
+    if total == 0:
+        return np.zeros(len(variances) + 1)
+    discarded = total - np.concatenate([[0], np.cumsum(variances)])
+    return np.maximum(discarded, 0) / total
+
+
+# The data projected onto its first few right singular vectors, so that the spectra can
+# be fitted in a space of dimension rank, rather than one with a dimension for every
+# signal. Created by ModelPlan before fitting, and the final fit at the optimum is
+# repeated with the full data.
+class CompressedData(FrozenPlan):
+    def __init__(self, data, rank, dtype=np.float64):
+        U, singularValues, Vh = np.linalg.svd(data, full_matrices=False)
+        self.rank = rank
+        self.data = freeze((U[:, :rank] * singularValues[:rank]).astype(dtype))
+        self.basis = freeze(Vh[:rank])
+        # Sum of the squares of the data and of the part of it that is discarded,
+        # which is added to the residuals of every fit in the compressed space.
+        self.totalVariance = float(np.sum(singularValues**2))
+        self.discardedVariance = float(np.sum(singularValues[rank:] ** 2))
+        self.freeze()
+
+
+class DataCompression(moduleFrame.Strategy):
+    requiredAttributes = ()
+
+    # Returns the rank to compress the data to, given its singular values.
+    @abstractmethod
+    def getRank(self, singularValues):
+        pass
+
+    # The data can only be compressed if all the signals are fitted together, without
+    # any constraints on the spectra that would be lost in the compressed space.
+    # Returns why it can't be, or None if it can.
+    def incompatibility(self):
+        titration = self.titration
+        if not isinstance(titration.fitSignals, FitSignalsUnconstrained):
+            return "the spectra aren't fitted by unconstrained least squares"
+        if titration.hasMissingDatapoints:
+            return "some datapoints are missing"
+        if not ma.getmaskarray(titration.knownSignals.run()).all():
+            return "some spectra are known"
+        if hasattr(titration.contributingSpecies, "signalToMoleculeMap"):
+            return "the signals are assigned to individual molecules"
+        return None
+
+    def canCompress(self):
+        return self.incompatibility() is None
+
+    def getCompressedRank(self, data):
+        return max(self.getRank(np.linalg.svd(data, compute_uv=False)), 1)
+
+    def run(self):
+        if not self.canCompress():
+            return None
+        data = np.asarray(self.titration.processedData)
+        rank = self.getCompressedRank(data)
+        if rank >= data.shape[1]:
+            return None
+        return CompressedData(data, rank, self.titration.fitDtype)
+
+    # Why run() doesn't compress the data, or None if it does.
+    def skippedReason(self):
+        incompatibility = self.incompatibility()
+        if incompatibility is not None:
+            return incompatibility
+        data = np.asarray(self.titration.processedData)
+        if self.getCompressedRank(data) >= data.shape[1]:
+            return "the rank isn't lower than the number of signals"
+        return None
+
+
+class DataCompressionNone(DataCompression):
+    def getRank(self, singularValues):
+        return len(singularValues)
+
+    def run(self):
+        return None
+
+    def skippedReason(self):
+        return None
+
+
+# Keeps every singular vector that isn't numerically zero, so the fit is the same as
+# without compression. The data has at most one singular vector per addition, so this
+# is always a large reduction for continuous spectra.
+class DataCompressionLossless(DataCompression):
+    def getRank(self, singularValues):
+        if len(singularValues) == 0:
+            return 0
+        shape = self.titration.processedData.shape
+        tolerance = singularValues[0] * max(shape) * np.finfo(float).eps
+        return int(np.count_nonzero(singularValues > tolerance))
+
+
+class CompressionRankTable(Table):
+    def __init__(self, master, titration):
+        super().__init__(
+            master,
+            0,
+            0,
+            ("Rank",),
+            maskBlanks=True,
+            rowOptions=("readonlyTitles",),
+            columnOptions=("readonlyTitles",),
+            boldTitles=True,
+            # empty rather than "?", as it is not a variable to be optimised
+            blankValue="",
+        )
+        rank = getattr(titration.dataCompression, "compressionRank", np.nan)
+        self.addRow("Compress to rank", ["" if np.isnan(rank) else int(rank)])
+
+
+class CompressionRankPopup(moduleFrame.Popup):
+    def __init__(self, titration, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.titration = titration
+        self.title("Choose rank")
+
+        self.frame = ttk.Frame(self)
+        self.frame.pack(expand=True, fill="both")
+
+        singularValues = np.linalg.svd(
+            ma.filled(titration.processedData, 0), compute_uv=False
+        )
+        fractions = discardedVarianceFractions(singularValues)
+        automaticRank = DataCompressionTruncated.automaticRank(singularValues)
+        varianceLines = "\n".join(
+            f"{rank}: {fraction:.3g}%"
+            for rank, fraction in enumerate(
+                fractions[1 : DataCompressionTruncated.ranksShown + 1] * 100, start=1
+            )
+        )
+        rankLabel = ttk.Label(
+            self.frame,
+            text=(
+                "Enter the number of singular vectors of the data to fit the spectra"
+                " with.\n"
+                f"Leave blank to choose automatically (currently {automaticRank}).\n\n"
+                f"Variance discarded at each rank:\n{varianceLines}"
+            ),
+        )
+        rankLabel.pack()
+
+        self.rankTable = CompressionRankTable(self.frame, titration)
+        self.rankTable.pack(expand=True, fill="both")
+
+        buttonFrame = ButtonFrame(self.frame, self.reset, self.saveData, self.destroy)
+        buttonFrame.pack(expand=False, fill="both", side="bottom")
+
+    def reset(self):
+        self.rankTable.data = np.array([[""]])
+
+    def saveData(self):
+        rank = ma.filled(self.rankTable.data, np.nan)[0, 0]
+        if not np.isnan(rank) and (rank < 1 or rank != int(rank)):
+            raise ValueError("The rank must be a positive integer.")
+
+        self.compressionRank = rank
+
+        self.saved = True
+        self.destroy()
+
+
+# Truncated SVD, keeping either the chosen number of singular vectors, or the fewest
+# that discard no more than maxDiscardedVariance of the variance of the data.
+class DataCompressionTruncated(DataCompression):
+    Popup = CompressionRankPopup
+    popupAttributes = ("compressionRank",)
+
+    maxDiscardedVariance = 1e-6
+    # Number of ranks for which the discarded variance is shown in the popup
+    ranksShown = 10
+
+    @classmethod
+    def automaticRank(cls, singularValues):
+        fractions = discardedVarianceFractions(singularValues)
+        return int(np.argmax(fractions <= cls.maxDiscardedVariance))
+
+    def getRank(self, singularValues):
+        if np.isnan(self.compressionRank):
+            return self.automaticRank(singularValues)
+        return int(min(self.compressionRank, len(singularValues)))
+
+
+class ModuleFrame(moduleFrame.ModuleFrame):
+    group = "Fitting"
+    dropdownLabelText = "Compress data before fitting?"
+    dropdownOptions = {
+        "No": DataCompressionNone,
+        "Lossless": DataCompressionLossless,
+        "Truncated SVD": DataCompressionTruncated,
+    }
+    attributeName = "dataCompression"
@@ -0,0 +1,119 @@
+import json
+import platform
+import time
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+from . import __version__
+
+# Percentiles of the wall time of each stage shown in the summary
+percentiles = (50, 90, 99)
+
+
+# Opt-in record of where the time is spent during a fit. Assigned to
+# Titration.diagnostics before fitting, after which optimisationFunc times each stage
+# of the model, and the speciation solver records its statistics.
+class FitDiagnostics:
+    def __init__(self):
+        self.created = time.time()
+        # Wall time of every call to each stage, in seconds
+        self.stageTimes = {}
+        # Number of times each event has happened
+        self.counters = {}
+        # Values to summarise with their distribution, such as the number of Newton
+        # iterations per point
+        self.samples = {}
+        # Any other values describing the fit
+        self.values = {}
+        self.model = {}
+
+    @contextmanager
+    def timeStage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stageTimes.setdefault(name, []).append(time.perf_counter() - start)
+
+    def count(self, name, increment=1):
+        self.counters[name] = self.counters.get(name, 0) + increment
+
+    def record(self, name, value):
+        self.values[name] = value
+
+    def addSamples(self, name, values):
+        self.samples.setdefault(name, []).extend(np.ravel(values).tolist())
+
+    # Record the strategy chosen for each module, so that fits of different models
+    # can be compared.
+    def describeModel(self, titration):
+        self.model = {
+            name: type(value).__name__
+            for name, value in vars(titration).items()
+            if hasattr(value, "requiredAttributes")
+        }
+
+    def stageSummary(self):
+        summary = {}
+        for name, times in self.stageTimes.items():
+            times = np.array(times)
+            summary[name] = {
+                "calls": len(times),
+                "total": float(np.sum(times)),
+                "mean": float(np.mean(times)),
+                **{
+                    f"p{q}": float(value)
+                    for q, value in zip(percentiles, np.percentile(times, percentiles))
+                },
+            }
+        return summary
+
+    def samplesSummary(self):
+        summary = {}
+        for name, values in self.samples.items():
+            if len(values) == 0:
+                continue
+            values = np.array(values)
+            summary[name] = {
+                "count": len(values),
+                "mean": float(np.mean(values)),
+                "max": float(np.max(values)),
+                **{
+                    f"p{q}": float(value)
+                    for q, value in zip(percentiles, np.percentile(values, percentiles))
+                },
+            }
+        return summary
+
+    def summary(self):
+        return {
+            "musketeerVersion": __version__,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.created)),
+            "machine": {
+                "platform": platform.platform(),
+                "processor": platform.processor(),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+            },
+            "model": self.model,
+            "stages": self.stageSummary(),
+            "counters": dict(self.counters),
+            "samples": self.samplesSummary(),
+            "values": dict(self.values),
+        }
+
+    def toJson(self):
+        return json.dumps(self.summary(), indent=2)
+
+    def saveJson(self, fileName):
+        with open(fileName, "w", encoding="utf-8") as f:
+            f.write(self.toJson())
+
+
+# Context manager timing a stage if diagnostics are being recorded, and doing nothing
+# otherwise.
+def timeStage(diagnostics, name):
+    if diagnostics is None:
+        return nullcontext()
+    return diagnostics.timeStage(name)
@@ -49,6 +49,12 @@ class EquilibriumConstants(moduleFrame.Strategy):
         ks[self.knownMask] = kVars
         return ma.compressed(ks)
 
+    # The output of run for each row of kVarsBatch
+    def runBatch(self, kVarsBatch):
+        ks = np.tile(ma.getdata(self.knownKs), (len(kVarsBatch), 1))
+        ks[:, self.knownMask] = kVarsBatch
+        return ks
+
 
 class GetKsAll(EquilibriumConstants):
     # when every equilibrium constant is unknown and independent
@@ -288,6 +294,9 @@ class GetKsCustom(EquilibriumConstants):
         globalKs = self.statisticalFactors * np.prod(microKs**self.ksMatrix, 0)
         return globalKs
 
+    def runBatch(self, kVarsBatch):
+        return np.array([self.run(kVars) for kVars in kVarsBatch])
+
 
 class KnownKsTable(Table):
     def __init__(self, master, titration):
@@ -1,5 +1,6 @@
 import tkinter.ttk as ttk
 from abc import abstractmethod
+from collections import OrderedDict
 
 import numpy as np
 from numpy import ma
@@ -7,9 +8,109 @@ from numpy.linalg import lstsq
 from scipy.optimize import lsq_linear
 
 from . import moduleFrame
+from .modelPlan import FitSignalsPlan
 from .table import ButtonFrame, Table
 
 
+# Values of the state of each variable in boundedLeastSquares
+FREE, AT_LOWER, AT_UPPER = 0, 1, 2
+# The states of each column are encoded as a single base 3 integer when grouping them.
+maxEncodedVariables = 39
+encodingWeights = 3 ** np.arange(maxEncodedVariables, dtype=np.int64)
+
+
+# Solves min ||x @ b - y||, subject to lower <= b <= upper, for every column of y at
+# once, using a primal-dual active set method on the normal equations. All columns
+# share the Gram matrix x.T @ x, and the columns with the same variables at each bound
+# are solved together, with a single factorisation of the corresponding submatrix.
+#
+# states gives the initial guess for which variables are free or at either bound, as
+# an array of shape (variables, columns). Returns b, the squared norm of the residuals,
+# the final states, and a boolean array indicating which columns have converged.
+def boundedLeastSquares(x, y, lower, upper, states=None, maxIterations=None):
+    x = np.asarray(x)
+    y = np.asarray(y)
+    variablesCount = x.shape[1]
+    columnsCount = y.shape[1]
+    if states is None:
+        states = np.full([variablesCount, columnsCount], FREE)
+    if maxIterations is None:
+        maxIterations = 3 * variablesCount + 10
+
+    # Scale each column of x to unit norm, to improve the conditioning of the Gram
+    # matrix.
+    norms = np.linalg.norm(x, axis=0)
+    scaling = np.where(norms > 0, 1 / np.where(norms > 0, norms, 1), 1)
+    gram = (x.T @ x) * scaling[:, np.newaxis] * scaling[np.newaxis, :]
+    c = (x.T @ y) * scaling[:, np.newaxis]
+    with np.errstate(invalid="ignore"):
+        scaledLower = np.full([variablesCount, 1], lower) / scaling[:, np.newaxis]
+        scaledUpper = np.full([variablesCount, 1], upper) / scaling[:, np.newaxis]
+
+    b = np.zeros([variablesCount, columnsCount])
+    converged = np.zeros(columnsCount, dtype=bool)
+    active = np.arange(columnsCount)
+    for _ in range(maxIterations):
+        activeStates = states[:, active]
+        if variablesCount <= maxEncodedVariables:
+            # Much faster than finding the unique columns directly
+            _, firstIndices, patternIndices = np.unique(
+                encodingWeights[:variablesCount] @ activeStates,
+                return_index=True,
+                return_inverse=True,
+            )
+            patterns = activeStates[:, firstIndices].T
+        else:
+            patterns, patternIndices = np.unique(
+                activeStates.T, axis=0, return_inverse=True
+            )
+        patternIndices = patternIndices.reshape(-1)
+        failed = np.zeros(len(active), dtype=bool)
+        for patternIndex, pattern in enumerate(patterns):
+            group = np.where(patternIndices == patternIndex)[0]
+            columns = active[group]
+            free = pattern == FREE
+            atLower = pattern == AT_LOWER
+            atUpper = pattern == AT_UPPER
+
+            groupB = np.empty([variablesCount, len(columns)])
+            groupB[atLower] = scaledLower[atLower]
+            groupB[atUpper] = scaledUpper[atUpper]
+            if np.any(free):
+                bound = ~free
+                rhs = (
+                    c[np.ix_(free, columns)] - gram[np.ix_(free, bound)] @ groupB[bound]
+                )
+                try:
+                    groupB[free] = np.linalg.solve(gram[np.ix_(free, free)], rhs)
+                except np.linalg.LinAlgError:
+                    failed[group] = True
+                    continue
+            b[:, columns] = groupB
+
+        # Columns with a singular submatrix are left to the caller
+        active = active[~failed]
+        gradient = gram @ b[:, active] - c[:, active]
+        # A step of unit length is a Newton step, as the Gram matrix has unit diagonal
+        trial = b[:, active] - gradient
+        with np.errstate(invalid="ignore"):
+            newStates = np.where(
+                trial < scaledLower,
+                AT_LOWER,
+                np.where(trial > scaledUpper, AT_UPPER, FREE),
+            )
+        unchanged = np.all(newStates == states[:, active], axis=0)
+        converged[active[unchanged]] = True
+        states[:, active] = newStates
+        active = active[~unchanged]
+        if len(active) == 0:
+            break
+
+    b *= scaling[:, np.newaxis]
+    residuals = np.sum((x @ b - y) ** 2, axis=0)
+    return b, residuals, states, converged
+
+
 class FitSignals(moduleFrame.Strategy):
     requiredAttributes = ()
 
@@ -17,96 +118,107 @@ class FitSignals(moduleFrame.Strategy):
     def leastSquares(self, x, y):
         pass
 
-    def run(self, contributorConcs, knownSpectra):
-        hasMissingDatapoints = ma.is_masked(self.titration.processedData)
-        hasKnownSpectra = np.any(ma.getmaskarray(knownSpectra) == False)  # noqa: E712
-        hasDifferentSignalsPerMolecule = hasattr(
-            self.titration.contributingSpecies, "signalToMoleculeMap"
+    # The frozen FitSignalsPlan compiled by Titration.optimise(), or a new one in
+    # double precision if this isn't being called during a fit.
+    def getPlan(self, knownSpectra):
+        modelPlan = getattr(self.titration, "plan", None)
+        if modelPlan is not None and modelPlan.fitSignals.source is self:
+            return modelPlan.fitSignals
+        return FitSignalsPlan(
+            self,
+            self.titration.processedData,
+            knownSpectra,
+            self.titration.contributors.plan,
         )
 
-        if hasMissingDatapoints or hasKnownSpectra or hasDifferentSignalsPerMolecule:
-            # need to process each signal separately
-            explainedData = ma.dot(contributorConcs, knownSpectra).filled(0)
-            unexplainedData = self.titration.processedData - explainedData
-
-            fittedSpectra = knownSpectra.copy()
-
-            signalsCount = unexplainedData.shape[1]
-            contributorsCount = self.titration.contributors.outputCount
-            residuals = np.empty(signalsCount)
+    # Returns the fitted spectra, as a plain array with arbitrary values for any
+    # spectra that are neither known nor fitted, and the squared residuals of each
+    # signal. This is all an optimiser needs, so is used within a fit.
+    def fit(self, contributorConcs, knownSpectra):
+        plan = self.getPlan(knownSpectra)
+        concs = ma.getdata(contributorConcs).astype(plan.data.dtype, copy=False)
+
+        if plan.fitSeparately:
+            # need to process each group of signals separately
+            if plan.hasKnownSpectra:
+                unexplainedData = plan.data - concs @ plan.knownSpectra
+            else:
+                unexplainedData = plan.data
 
-            if hasattr(self.titration.contributingSpecies, "signalToMoleculeMap"):
-                splitIndices = np.cumsum(
-                    self.titration.contributors.contributorsCountPerMolecule
-                )[:-1]
+            fittedSpectra = plan.knownSpectra.copy()
+            residuals = np.empty(plan.data.shape[1])
 
-                # For each signal, take only the relevant contributors' concentrations
-                contributorsSlicePerMolecule = np.split(
-                    np.arange(contributorsCount), splitIndices
-                )
-                contributorsSlicePerSignal = [
-                    contributorsSlicePerMolecule[molecule]
-                    for molecule in self.titration.contributingSpecies.signalToMoleculeMap
-                ]
-
-            else:
-                contributorsSlicePerSignal = [
-                    np.arange(contributorsCount)
-                ] * signalsCount
-
-            for index, (
-                signalData,
-                signalKnownSpectra,
-                signalContributorsSlice,
-            ) in enumerate(
-                zip(
-                    unexplainedData.T,
-                    knownSpectra.T,
-                    contributorsSlicePerSignal,
-                )
-            ):
-                dataMask = ~ma.getmaskarray(signalData)
-                unknownSpectraMask = ma.getmaskarray(
-                    signalKnownSpectra[signalContributorsSlice]
-                )
-                unknownSpectraSlice = signalContributorsSlice[unknownSpectraMask]
-                relevantContributorConcs = contributorConcs[dataMask, :][
-                    :, unknownSpectraSlice
-                ]
+            for rows, unknownSpectra, signals in plan.signalGroups:
+                relevantContributorConcs = concs[np.ix_(rows, unknownSpectra)]
+                signalsData = unexplainedData[np.ix_(rows, signals)]
 
+                (
+                    fittedSpectra[np.ix_(unknownSpectra, signals)],
+                    signalsResiduals,
+                ) = self.leastSquares(relevantContributorConcs, signalsData)
                 try:
-                    (
-                        fittedSpectra[unknownSpectraSlice, index],
-                        residuals[index],
-                    ) = self.leastSquares(
-                        relevantContributorConcs, signalData.compressed()
-                    )
+                    residuals[signals] = signalsResiduals
                 except ValueError:
                     # Should only happen with incorrect constraints
-                    (fittedSpectra[unknownSpectraSlice, index], _) = self.leastSquares(
-                        relevantContributorConcs, signalData.compressed()
-                    )
-                    residuals[index] = (
+                    residuals[signals] = (
                         np.linalg.norm(
                             relevantContributorConcs
-                            @ fittedSpectra[unknownSpectraSlice, index]
-                            - signalData.compressed(),
+                            @ fittedSpectra[np.ix_(unknownSpectra, signals)]
+                            - signalsData,
                             ord=2,
+                            axis=0,
                         )
                         ** 2
                     )
-            fittedCurves = ma.dot(contributorConcs, fittedSpectra)
-
-            # Make the smooth curves ignore masked values, rather than treating them as
-            # zeros.
-            fittedCurves.data[fittedCurves.mask] = np.nan
+        elif (compressedData := self.titration.compressedData) is not None:
+            # fit in the compressed space, adding the constant contribution of the
+            # discarded part of the data to the residuals
+            fittedSpectra, residuals = self.leastSquares(concs, compressedData.data)
+            residuals = np.append(residuals, compressedData.discardedVariance)
         else:
             # can process all signals at once
-            fittedSpectra, residuals = self.leastSquares(
-                contributorConcs, self.titration.processedData
-            )
-            fittedCurves = ma.dot(contributorConcs, fittedSpectra)
+            fittedSpectra, residuals = self.leastSquares(concs, plan.data)
+        return fittedSpectra, residuals
+
+    # The squared residuals of each signal for each of a population of contributor
+    # concentrations, of shape (population, additions, contributors).
+    def fitBatch(self, contributorConcsBatch, knownSpectra):
+        return np.array(
+            [
+                self.fit(contributorConcs, knownSpectra)[1]
+                for contributorConcs in contributorConcsBatch
+            ]
+        )
+
+    # The differences between the data and the fitted curves, with 0 for any missing
+    # datapoints. If the data is compressed, this excludes the constant discarded part
+    # of the data.
+    def residualVector(self, fittedSpectra, contributorConcs, knownSpectra):
+        plan = self.getPlan(knownSpectra)
+        fittedCurves = ma.getdata(contributorConcs) @ fittedSpectra
+        if (compressedData := self.titration.compressedData) is not None:
+            return compressedData.data - fittedCurves
+        residuals = plan.data - fittedCurves
+        residuals[plan.excludedResiduals] = 0
+        return residuals
+
+    # Converts the result of fit to masked arrays of the fitted spectra and curves,
+    # for display and saving.
+    def materialise(self, fittedSpectra, contributorConcs, knownSpectra):
+        plan = self.getPlan(knownSpectra)
+        fittedCurves = ma.getdata(contributorConcs) @ fittedSpectra
+        return (
+            plan.maskSpectra(fittedSpectra),
+            plan.maskCurves(fittedCurves, contributorConcs),
+        )
 
+    # Returns the fitted spectra, the squared residuals of each signal, and the fitted
+    # curves, as masked arrays.
+    def run(self, contributorConcs, knownSpectra):
+        fittedSpectra, residuals = self.fit(contributorConcs, knownSpectra)
+        fittedSpectra, fittedCurves = self.materialise(
+            fittedSpectra, contributorConcs, knownSpectra
+        )
         return fittedSpectra, residuals, fittedCurves
 
 
@@ -114,9 +226,31 @@ class FitSignalsUnconstrained(FitSignals):
     def leastSquares(self, x, y):
         b, residuals, _, _ = lstsq(x, y, rcond=None)
         if residuals.size == 0:
-            residuals = np.linalg.norm(ma.dot(x, b) - y, ord=2, axis=0) ** 2
+            residuals = np.linalg.norm(x @ b - y, ord=2, axis=0) ** 2
         return b, residuals
 
+    # When all signals are fitted at once, the whole population is fitted with a
+    # single batched pseudoinverse, using the same cutoff for small singular values
+    # as lstsq.
+    def fitBatch(self, contributorConcsBatch, knownSpectra):
+        plan = self.getPlan(knownSpectra)
+        if plan.fitSeparately:
+            return super().fitBatch(contributorConcsBatch, knownSpectra)
+        x = ma.getdata(contributorConcsBatch).astype(plan.data.dtype, copy=False)
+        compressedData = self.titration.compressedData
+        y = plan.data if compressedData is None else compressedData.data
+
+        rcond = np.finfo(x.dtype).eps * max(x.shape[1:])
+        b = np.linalg.pinv(x, rcond) @ y
+        residuals = np.sum((x @ b - y) ** 2, axis=-2)
+        if compressedData is not None:
+            residuals = np.append(
+                residuals,
+                np.full((len(residuals), 1), compressedData.discardedVariance),
+                axis=1,
+            )
+        return residuals
+
 
 class SignalConstraintsTable(Table):
     def __init__(self, master, titration):
@@ -184,13 +318,50 @@ class SignalConstraintsPopup(moduleFrame.Popup):
 class FitSignalsConstrained(FitSignals):
     requiredAttributes = FitSignals.requiredAttributes + ("signalConstraints",)
 
+    # Number of previous sets of active constraints to keep, to use as initial
+    # guesses for boundedLeastSquares.
+    warmStartCacheSize = 8
+
     def leastSquares(self, x, y):
         if y.ndim == 1:
             return self.leastSquaresSingle(x, y)
-        else:
+
+        lower, upper = self.signalConstraints
+        if not lower < upper or x.shape[1] == 0 or y.shape[1] == 1:
+            # Let lsq_linear handle any invalid constraints. It is also faster for a
+            # single column.
             b, residuals = zip(*[self.leastSquaresSingle(x, col) for col in y.T])
             return np.array(b).T, np.array(residuals)
 
+        # The same problem is solved repeatedly during a fit, so start from the
+        # constraints that were active last time.
+        key = (x.shape, y.shape)
+        b, residuals, states, converged = boundedLeastSquares(
+            x, y, lower, upper, self.getWarmStart(key)
+        )
+        self.storeWarmStart(key, states)
+
+        for column in np.where(~converged)[0]:
+            b[:, column], residuals[column] = self.leastSquaresSingle(x, y[:, column])
+        return b, residuals
+
+    def getWarmStart(self, key):
+        cache = getattr(self, "warmStartCache", None)
+        if cache is None or key not in cache:
+            return None
+        cache.move_to_end(key)
+        return cache[key].copy()
+
+    def storeWarmStart(self, key, states):
+        if self.warmStartCacheSize <= 0:
+            return
+        if getattr(self, "warmStartCache", None) is None:
+            self.warmStartCache = OrderedDict()
+        self.warmStartCache[key] = states
+        self.warmStartCache.move_to_end(key)
+        while len(self.warmStartCache) > self.warmStartCacheSize:
+            self.warmStartCache.popitem(last=False)
+
     def leastSquaresSingle(self, x, y):
         result = lsq_linear(
             x,
@@ -211,24 +382,60 @@ class FitSignalsCustom(FitSignalsConstrained):
     popupAttributes = ("signalConstraints",)
 
 
+# Total least squares, allowing for errors in the contributor concentrations as well as
+# in the signals. Each signal is fitted separately, as a single total least squares
+# problem for all signals at once has no unique solution whenever there are more
+# signals than additions.
 class FitSignalsODR(FitSignals):
-    def run(self, contributorConcs, knownSpectra):
-        X = np.asarray(contributorConcs)
-        Y = np.asarray(self.titration.processedData)
-        relativeWeightYOverX = 100
-        scaling = (Y.mean() * Y.size) / (X.mean() * X.size) / relativeWeightYOverX
-        m, n = X.shape
-        XY = np.hstack([X, Y / scaling])
-        U, s, Vh = np.linalg.svd(XY)
-        V = Vh.T
-        Vxy = V[:n, n:]
-        Vyy = V[n:, n:]
-        B = scaling * -Vxy @ np.linalg.inv(Vyy)
-        EF = -XY @ V[:, n:] @ V[:, n:].T
-        E, F = EF[:, :n], EF[:, n:]
-        norm = np.linalg.norm(EF, ord="fro")
-        fittedCurves = X @ B
-        return B, norm**2, fittedCurves
+    # Weight of the errors in the signals relative to those in the concentrations
+    relativeWeightYOverX = 100
+
+    def leastSquares(self, x, y):
+        x = np.asarray(x)
+        y = np.asarray(y)
+        if y.ndim == 1:
+            b, residuals = self.leastSquares(x, y[:, np.newaxis])
+            return b[:, 0], residuals[0]
+
+        additionsCount, contributorsCount = x.shape
+        if contributorsCount == 0 or additionsCount <= contributorsCount:
+            # Nothing to correct, or too few points for any error to be estimated
+            return FitSignalsUnconstrained.leastSquares(self, x, y)
+
+        scaling = np.sum(np.abs(y)) / np.sum(np.abs(x)) / self.relativeWeightYOverX
+        if not np.isfinite(scaling) or scaling == 0:
+            scaling = 1
+
+        # For each signal, the smallest right singular vector of the augmented matrix
+        # [x, y / scaling] is the eigenvector of its Gram matrix with the smallest
+        # eigenvalue. These only differ in their last row and column, so are built
+        # from x.T @ x and x.T @ y without forming the augmented matrices.
+        scaledY = y / scaling
+        xTy = x.T @ scaledY
+        gram = np.empty([y.shape[1], contributorsCount + 1, contributorsCount + 1])
+        gram[:, :contributorsCount, :contributorsCount] = x.T @ x
+        gram[:, :contributorsCount, contributorsCount] = xTy.T
+        gram[:, contributorsCount, :contributorsCount] = xTy.T
+        gram[:, contributorsCount, contributorsCount] = np.sum(scaledY**2, axis=0)
+        eigenvalues, eigenvectors = np.linalg.eigh(gram)
+        smallestVectors = eigenvectors[:, :, 0]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            b = (
+                -scaling
+                * smallestVectors[:, :contributorsCount]
+                / smallestVectors[:, contributorsCount:]
+            ).T
+        # The sum of the squared orthogonal distances, in units of the signals
+        residuals = np.maximum(eigenvalues[:, 0], 0) * scaling**2
+
+        degenerate = ~np.all(np.isfinite(b), axis=0)
+        if np.any(degenerate):
+            (
+                b[:, degenerate],
+                residuals[degenerate],
+            ) = FitSignalsUnconstrained.leastSquares(self, x, y[:, degenerate])
+        return b, residuals
 
 
 class ModuleFrame(moduleFrame.ModuleFrame):
@@ -238,6 +445,6 @@ class ModuleFrame(moduleFrame.ModuleFrame):
         "No": FitSignalsUnconstrained,
         "Nonnegative": FitSignalsNonnegative,
         "Custom constraints": FitSignalsCustom,
-        # "USE ODR": FitSignalsODR,
+        "No, with orthogonal distance regression": FitSignalsODR,
     }
     attributeName = "fitSignals"
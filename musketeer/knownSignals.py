@@ -17,6 +17,9 @@ class KnownSignals(moduleFrame.Strategy):
     requiredAttributes = ("knownSpectra",)
 
     def run(self):
+        modelPlan = getattr(self.titration, "plan", None)
+        if modelPlan is not None and modelPlan.knownSignalsSource is self:
+            return modelPlan.knownSpectra
         return self.knownSpectra
 
 
@@ -247,26 +250,55 @@ class GetKnownSpectra(KnownSignals):
         else:
             return KnownSpectraPopup
 
+    # The known spectra, rearranged to match the current contributors and signals.
+    # Cached until the stored spectra, or the titles of the contributors or signals,
+    # change.
     @property
     def knownSpectra(self):
         currentContributors = self.titration.contributors.outputNames
-        lastContributors = self.spectraTitles
-        lastSignals = self.signalTitles
         currentSignals = self.titration.processedSignalTitlesStrings
-
-        if not set(currentSignals).issubset(lastSignals):
-            return ma.masked_all((len(currentContributors), len(currentSignals)))
-        relevantSignalIndices = [
-            np.where(lastSignals == signal)[0][0] for signal in currentSignals
-        ]
-        relevantSignals = self._knownSpectra[:, relevantSignalIndices]
-
+        sources = (self._knownSpectra, self.spectraTitles, self.signalTitles)
+
+        cache = self.__dict__.get("_alignedSpectraCache")
+        if (
+            cache is None
+            or any(a is not b for a, b in zip(cache["sources"], sources))
+            or cache["currentSignals"] is not currentSignals
+            or not np.array_equal(cache["currentContributors"], currentContributors)
+        ):
+            cache = {
+                "sources": sources,
+                "currentSignals": currentSignals,
+                "currentContributors": currentContributors,
+                "spectra": self.alignSpectra(currentContributors, currentSignals),
+            }
+            self._alignedSpectraCache = cache
+        return cache["spectra"].copy()
+
+    def alignSpectra(self, currentContributors, currentSignals):
         output = ma.masked_all((len(currentContributors), len(currentSignals)))
-        for spectrumTitle, spectrum in zip(lastContributors, relevantSignals):
-            if spectrumTitle in currentContributors:
-                output[
-                    np.where(currentContributors == spectrumTitle)[0][0], :
-                ] = spectrum
+
+        # Index of the first occurrence of each title in the stored known spectra
+        lastSignalIndices = {}
+        for index, signal in enumerate(self.signalTitles):
+            lastSignalIndices.setdefault(signal, index)
+        signalIndices = [lastSignalIndices.get(signal) for signal in currentSignals]
+        if None in signalIndices:
+            return output
+
+        currentContributorIndices = {}
+        for index, contributor in enumerate(currentContributors):
+            currentContributorIndices.setdefault(contributor, index)
+        targetIndices, sourceIndices = [], []
+        for index, spectrumTitle in enumerate(self.spectraTitles):
+            if spectrumTitle in currentContributorIndices:
+                targetIndices.append(currentContributorIndices[spectrumTitle])
+                sourceIndices.append(index)
+
+        if sourceIndices:
+            output[targetIndices] = self._knownSpectra[
+                np.ix_(sourceIndices, signalIndices)
+            ]
         return output
 
     @knownSpectra.setter
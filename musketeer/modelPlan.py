@@ -0,0 +1,281 @@
+from types import MappingProxyType
+
+import numpy as np
+from numpy import ma
+
+
+def freeze(array):
+    array = np.array(array)
+    array.setflags(write=False)
+    return array
+
+
+# The molecule of each contributor, and the matrix summing the contributors of each
+# molecule, of shape (contributors, molecules).
+def moleculeSumMatrix(contributorsCountPerMolecule):
+    moleculeCount = len(contributorsCountPerMolecule)
+    moleculeIndices = np.repeat(np.arange(moleculeCount), contributorsCountPerMolecule)
+    moleculeMatrix = np.equal.outer(moleculeIndices, np.arange(moleculeCount))
+    return moleculeIndices, moleculeMatrix.astype(float)
+
+
+class FrozenPlan:
+    # Attributes can only be set in __init__, after which freeze() must be called.
+    def __setattr__(self, name, value):
+        if getattr(self, "_frozen", False):
+            raise AttributeError(
+                f"Can't set attribute {name} of a frozen {type(self).__name__}"
+            )
+        super().__setattr__(name, value)
+
+    def freeze(self):
+        super().__setattr__("_frozen", True)
+
+
+class ZeroPattern(FrozenPlan):
+    # Sub-model for the additions where the components in zeroFree have a total
+    # concentration of 0, so that any species containing them can be filtered out.
+    def __init__(self, speciationPlan, zeroFree):
+        self.zeroFree = freeze(zeroFree)
+        self.nonzeroFree = freeze(~zeroFree)
+
+        zeroBound = np.any(speciationPlan.stoichiometries[:, zeroFree], axis=1)
+        self.allZero = bool(np.all(zeroBound))
+        self.complexFilter = freeze(~zeroBound[speciationPlan.complexIndices])
+        self.polymerFilter = freeze(~zeroBound[speciationPlan.polymerIndices])
+
+        self.complexStoichiometries = freeze(
+            speciationPlan.complexStoichiometries[self.complexFilter, :][
+                :, self.nonzeroFree
+            ]
+        )
+        self.polymerStoichiometries = freeze(
+            speciationPlan.polymerStoichiometries[self.polymerFilter, :][
+                :, self.nonzeroFree
+            ]
+        )
+        self.freeze()
+
+
+class SpeciationPlan(FrozenPlan):
+    def __init__(self, speciation, totalConcs=None):
+        self.source = speciation
+
+        self.freeCount = speciation.freeCount
+        self.stoichiometries = freeze(speciation.stoichiometries)
+        self.complexIndices = freeze(speciation.complexIndices)
+        self.polymerIndices = freeze(speciation.polymerIndices)
+        self.complexCount = int(np.count_nonzero(self.complexIndices))
+        self.polymerCount = int(np.count_nonzero(self.polymerIndices))
+        self.complexStoichiometries = freeze(self.stoichiometries[self.complexIndices])
+        self.polymerStoichiometries = freeze(self.stoichiometries[self.polymerIndices])
+        self.outputStoichiometries = freeze(speciation.outputStoichiometries)
+        self.outputCount = self.outputStoichiometries.shape[0]
+
+        # End group (pos) and polymer (neg) stoichiometries, and the stoichiometries
+        # used by polymerFreeToBoundConcs.
+        M = self.polymerStoichiometries
+        self.polymerPos = freeze(np.where(M < 0, 0, M))
+        self.polymerNeg = freeze(np.where(M < 0, np.abs(M), 0))
+        fullStoichiometries = np.zeros([self.polymerCount * 2, self.freeCount * 3])
+        fullStoichiometries[::2, : self.freeCount] = self.polymerPos
+        fullStoichiometries[1::2, : self.freeCount] = self.polymerPos
+        fullStoichiometries[::2, self.freeCount : self.freeCount * 2] = self.polymerNeg
+        fullStoichiometries[1::2, self.freeCount * 2 :] = self.polymerNeg
+        self.fullPolymerStoichiometries = freeze(fullStoichiometries)
+
+        # Indices used by splitPolymerKs to place each polymer K
+        k2Components, knComponents, kabsPolymers = [], [], []
+        k2Positions, knPositions, kabsPositions = [], [], []
+        position = 0
+        for polymerIndex, row in enumerate(M):
+            freeIndex = np.where(row < 0)[0][0]
+            if np.count_nonzero(row) == 1:
+                k2Components.append(freeIndex)
+                k2Positions.append(position)
+                knComponents.append(freeIndex)
+                knPositions.append(position + 1)
+                position += 2
+            else:
+                kabsPolymers.append(polymerIndex)
+                kabsPositions.append(position)
+                position += 1
+        self.k2Components = freeze(np.array(k2Components, dtype=int))
+        self.knComponents = freeze(np.array(knComponents, dtype=int))
+        self.kabsPolymers = freeze(np.array(kabsPolymers, dtype=int))
+        self.k2Positions = freeze(np.array(k2Positions, dtype=int))
+        self.knPositions = freeze(np.array(knPositions, dtype=int))
+        self.kabsPositions = freeze(np.array(kabsPositions, dtype=int))
+
+        # Sub-models for each distinct set of components with a total concentration
+        # of 0, as found in totalConcs.
+        zeroPatterns = {}
+        if totalConcs is not None:
+            for zeroFree in np.unique(totalConcs == 0, axis=0):
+                zeroPatterns[zeroFree.tobytes()] = ZeroPattern(self, zeroFree)
+        self.zeroPatterns = MappingProxyType(zeroPatterns)
+        self.freeze()
+
+    def getZeroPattern(self, zeroFree):
+        try:
+            return self.zeroPatterns[zeroFree.tobytes()]
+        except KeyError:
+            return ZeroPattern(self, zeroFree)
+
+
+class ContributorsPlan(FrozenPlan):
+    def __init__(self, contributors, contributingSpecies):
+        self.source = contributors
+        self.contributingSpeciesSource = contributingSpecies
+
+        self.filter = freeze(contributingSpecies.filter)
+        self.contributorsMatrix = freeze(contributors.contributorsMatrix)
+        self.contributorsMatrixT = freeze(self.contributorsMatrix.T)
+        self.contributorsCountPerMolecule = freeze(
+            contributors.contributorsCountPerMolecule
+        )
+        self.outputCount = self.contributorsMatrix.shape[0]
+
+        # Used by GetFraction to sum the contributors of each molecule
+        moleculeIndices, moleculeMatrix = moleculeSumMatrix(
+            self.contributorsCountPerMolecule
+        )
+        self.moleculeIndices = freeze(moleculeIndices)
+        self.moleculeMatrix = freeze(moleculeMatrix)
+
+        # For each signal, the indices of the contributors it depends on
+        self.hasDifferentSignalsPerMolecule = hasattr(
+            contributingSpecies, "signalToMoleculeMap"
+        )
+        if self.hasDifferentSignalsPerMolecule:
+            splitIndices = np.cumsum(self.contributorsCountPerMolecule)[:-1]
+            contributorsSlicePerMolecule = [
+                freeze(indices)
+                for indices in np.split(np.arange(self.outputCount), splitIndices)
+            ]
+            self.contributorsSlicePerSignal = tuple(
+                contributorsSlicePerMolecule[molecule]
+                for molecule in contributingSpecies.signalToMoleculeMap
+            )
+            # The same, as a boolean array of shape (contributors, signals)
+            contributorsFilterPerSignal = np.zeros(
+                [self.outputCount, len(self.contributorsSlicePerSignal)], dtype=bool
+            )
+            for signal, indices in enumerate(self.contributorsSlicePerSignal):
+                contributorsFilterPerSignal[indices, signal] = True
+            self.contributorsFilterPerSignal = freeze(contributorsFilterPerSignal)
+        else:
+            self.contributorsSlicePerSignal = None
+            self.contributorsFilterPerSignal = None
+        self.freeze()
+
+
+class FitSignalsPlan(FrozenPlan):
+    # Dense copies of the data and known spectra, with boolean masks of their missing
+    # values, as operations on masked arrays are several times slower. The signals are
+    # grouped by which datapoints they have and which spectra need fitting, so that
+    # each group can be fitted with a single call to leastSquares. The fitted spectra
+    # and curves are only converted back to masked arrays for display and saving.
+    def __init__(
+        self, fitSignals, data, knownSpectra, contributorsPlan, dtype=np.float64
+    ):
+        self.source = fitSignals
+
+        self.missingData = freeze(ma.getmaskarray(data))
+        self.data = freeze(ma.filled(data, 0).astype(dtype))
+        self.unknownSpectra = freeze(ma.getmaskarray(knownSpectra))
+        self.knownSpectra = freeze(ma.filled(knownSpectra, 0).astype(dtype))
+
+        self.hasMissingDatapoints = bool(np.any(self.missingData))
+        self.hasKnownSpectra = not np.all(self.unknownSpectra)
+        self.fitSeparately = (
+            self.hasMissingDatapoints
+            or self.hasKnownSpectra
+            or contributorsPlan.hasDifferentSignalsPerMolecule
+        )
+
+        additionsCount, signalsCount = self.data.shape
+        if contributorsPlan.hasDifferentSignalsPerMolecule:
+            # For each signal, only the relevant contributors' spectra are fitted
+            contributorsFilter = contributorsPlan.contributorsFilterPerSignal
+        else:
+            contributorsFilter = np.ones(
+                [contributorsPlan.outputCount, signalsCount], dtype=bool
+            )
+        fittedSpectra = contributorsFilter & self.unknownSpectra
+        # Spectra that are neither known nor fitted, and the fitted curves and
+        # residuals that they leave undefined.
+        self.unfittedSpectra = freeze(self.unknownSpectra & ~contributorsFilter)
+        self.missingCurves = freeze(
+            np.broadcast_to(np.all(self.unfittedSpectra, axis=0), self.data.shape)
+        )
+        self.excludedResiduals = freeze(self.missingData | self.missingCurves)
+
+        # The rows, unknown spectra and signals of each group, as index arrays
+        signalGroups = []
+        if self.fitSeparately:
+            patterns, patternIndices = np.unique(
+                np.vstack([~self.missingData, fittedSpectra]).T,
+                axis=0,
+                return_inverse=True,
+            )
+            patternIndices = patternIndices.reshape(-1)
+            for patternIndex, pattern in enumerate(patterns):
+                signalGroups.append(
+                    (
+                        freeze(np.flatnonzero(pattern[:additionsCount])),
+                        freeze(np.flatnonzero(pattern[additionsCount:])),
+                        freeze(np.flatnonzero(patternIndices == patternIndex)),
+                    )
+                )
+        self.signalGroups = tuple(signalGroups)
+        self.freeze()
+
+    def maskSpectra(self, fittedSpectra):
+        return ma.masked_array(fittedSpectra, self.unfittedSpectra)
+
+    # contributorConcs is only masked if a molecule has a total concentration of 0.
+    def maskCurves(self, fittedCurves, contributorConcs):
+        if ma.is_masked(contributorConcs):
+            availableConcs = ~ma.getmaskarray(contributorConcs)
+            mask = (availableConcs.astype(int) @ (~self.unfittedSpectra)) == 0
+        else:
+            mask = self.missingCurves
+        fittedCurves = np.array(fittedCurves)
+        # Make the smooth curves ignore masked values, rather than treating them as
+        # zeros.
+        fittedCurves[mask] = np.nan
+        return ma.masked_array(fittedCurves, mask)
+
+
+class ModelPlan(FrozenPlan):
+    # Snapshot of the model, taken by Titration.optimise() before fitting, so that the
+    # matrices and index maps used in the optimisation loop are only computed once.
+    def __init__(self, titration):
+        initialGuess = titration.totalConcentrations.variableInitialGuesses
+        totalConcs = titration.totalConcentrations.run(initialGuess)
+
+        self.speciation = SpeciationPlan(titration.speciation, totalConcs)
+        self.contributors = ContributorsPlan(
+            titration.contributors, titration.contributingSpecies
+        )
+        self.knownSignalsSource = titration.knownSignals
+        self.knownSpectra = titration.knownSignals.run()
+        self.knownSpectra.setflags(write=False)
+
+        # The data and known spectra in the precision used for fitting
+        self.dtype = titration.fitDtype
+        self.fitSignals = FitSignalsPlan(
+            titration.fitSignals,
+            titration.processedData,
+            self.knownSpectra,
+            self.contributors,
+            self.dtype,
+        )
+
+        # CompressedData to fit the spectra in, or None to use the full data
+        if titration.dataCompression is None:
+            self.compressedData = None
+        else:
+            self.compressedData = titration.dataCompression.run()
+        self.freeze()
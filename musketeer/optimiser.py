@@ -0,0 +1,478 @@
+import multiprocessing
+import tkinter.ttk as ttk
+from abc import abstractmethod
+from collections import OrderedDict
+
+import numpy as np
+from scipy.optimize import differential_evolution, least_squares, minimize
+from scipy.stats import qmc
+
+from . import moduleFrame
+from .modelPlan import ModelPlan
+from .table import ButtonFrame, Table
+
+
+class Optimiser(moduleFrame.Strategy):
+    requiredAttributes = ()
+
+    # Takes the initial guesses for log10 of the unknown Ks and total concentrations,
+    # and returns their optimised values.
+    @abstractmethod
+    def run(self, initialGuess, callback=None):
+        pass
+
+
+class OptimiserNelderMead(Optimiser):
+    def run(self, initialGuess, callback=None):
+        result = localFit(self.titration, initialGuess, callback)
+        if not result.success:
+            self.titration.fitConverged = False
+        return result.x
+
+
+# Levenberg-Marquardt on the vector of residuals. The fitted spectra are linear
+# parameters, which are already eliminated by FitSignals in every evaluation, so this
+# optimises the variable projection functional of only the Ks and total
+# concentrations.
+class OptimiserLevenbergMarquardt(Optimiser):
+    # Bounds on log10 of the Ks and of the unknown total concentrations
+    logKBounds = np.array([-np.inf, np.inf])
+    logConcBounds = np.array([-np.inf, np.inf])
+
+    # The Jacobian is found by finite differences, so the speciation needs to be
+    # solved much more precisely than the size of the steps taken. With a reduced
+    # precision, larger steps are needed.
+    speciationTolerance = 1e-10
+    relativeStep = 1e-6
+
+    def getBounds(self):
+        kCount = self.titration.equilibriumConstants.variableCount
+        concCount = self.titration.totalConcentrations.variableCount
+        lowerBounds = np.concatenate(
+            [
+                np.full(kCount, self.logKBounds[0]),
+                np.full(concCount, self.logConcBounds[0]),
+            ]
+        )
+        upperBounds = np.concatenate(
+            [
+                np.full(kCount, self.logKBounds[1]),
+                np.full(concCount, self.logConcBounds[1]),
+            ]
+        )
+        return lowerBounds, upperBounds
+
+    def residuals(self, logKsAndTotalConcs, callback):
+        residuals = self.titration.optimisationResidualsLog(logKsAndTotalConcs)
+        if callback is not None:
+            callback(logKsAndTotalConcs)
+        return residuals
+
+    def run(self, initialGuess, callback=None):
+        lowerBounds, upperBounds = self.getBounds()
+        if np.all(np.isinf(lowerBounds)) and np.all(np.isinf(upperBounds)):
+            method = "lm"
+        else:
+            # The "lm" method doesn't support bounds, and the trust region reflective
+            # method requires the initial guess to be strictly within them.
+            method = "trf"
+            margin = np.minimum(1e-3, (upperBounds - lowerBounds) / 4)
+            initialGuess = np.clip(
+                initialGuess, lowerBounds + margin, upperBounds - margin
+            )
+
+        speciation = self.titration.speciation
+        hasTolerance = hasattr(speciation, "tolerance")
+        if hasTolerance:
+            previousTolerance = vars(speciation).get("tolerance")
+            speciation.tolerance = self.speciationTolerance
+        try:
+            result = least_squares(
+                self.residuals,
+                x0=initialGuess,
+                bounds=(lowerBounds, upperBounds),
+                method=method,
+                diff_step=max(
+                    self.relativeStep,
+                    np.sqrt(np.finfo(self.titration.fitDtype).eps),
+                ),
+                args=(callback,),
+            )
+            if result.status <= 0:
+                self.titration.fitConverged = False
+        finally:
+            if hasTolerance and previousTolerance is None:
+                del speciation.tolerance
+            elif hasTolerance:
+                speciation.tolerance = previousTolerance
+        return result.x
+
+
+class LogBoundsTable(Table):
+    def __init__(self, master, titration):
+        optimiser = titration.optimiser
+        bounds = [
+            getattr(optimiser, "logKBounds", OptimiserLevenbergMarquardt.logKBounds),
+            getattr(
+                optimiser, "logConcBounds", OptimiserLevenbergMarquardt.logConcBounds
+            ),
+        ]
+        super().__init__(
+            master,
+            0,
+            0,
+            ("Lower", "Upper"),
+            maskBlanks=True,
+            rowOptions=("readonlyTitles",),
+            columnOptions=("readonlyTitles",),
+            boldTitles=True,
+            # empty rather than "?", as it is not a variable to be optimised
+            blankValue="",
+        )
+        for name, row in zip(("log₁₀ K", "log₁₀ concentration"), bounds):
+            self.addRow(name, np.where(np.isinf(row), "", row))
+
+
+class LogBoundsPopup(moduleFrame.Popup):
+    def __init__(self, titration, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.titration = titration
+        self.title("Enter bounds")
+
+        self.frame = ttk.Frame(self)
+        self.frame.pack(expand=True, fill="both")
+
+        boundsLabel = ttk.Label(
+            self.frame,
+            text=(
+                "Enter bounds on log₁₀ of the unknown Ks and concentrations.\n"
+                "Leave cells blank for no lower/upper bound."
+            ),
+        )
+        boundsLabel.pack()
+
+        self.boundsTable = LogBoundsTable(self.frame, titration)
+        self.boundsTable.pack(expand=True, fill="both")
+
+        buttonFrame = ButtonFrame(self.frame, self.reset, self.saveData, self.destroy)
+        buttonFrame.pack(expand=False, fill="both", side="bottom")
+
+    def reset(self):
+        self.boundsTable.data = np.array([["", ""], ["", ""]])
+
+    def saveData(self):
+        data = self.boundsTable.data
+        bounds = np.where(np.isnan(data), (-np.inf, np.inf), data)
+        if np.any(bounds[:, 0] >= bounds[:, 1]):
+            raise ValueError("Each lower bound must be less than the upper bound.")
+
+        self.logKBounds, self.logConcBounds = bounds
+
+        self.saved = True
+        self.destroy()
+
+
+class OptimiserLevenbergMarquardtBounded(OptimiserLevenbergMarquardt):
+    Popup = LogBoundsPopup
+    popupAttributes = ("logKBounds", "logConcBounds")
+
+
+# A Nelder-Mead fit from a single starting point, returning scipy's OptimizeResult.
+# With the tolerances of Titration.convergence, each parameter is divided by its
+# tolerance, so that the simplex converges once it is smaller than the tolerance in
+# every parameter.
+def localFit(titration, start, callback=None):
+    tolerances = titration.logTolerances
+    if tolerances is None:
+        return minimize(
+            titration.optimisationFuncLog,
+            x0=start,
+            method="nelder-mead",
+            callback=callback,
+        )
+
+    # scipy's default tolerance is used for any parameter without one.
+    tolerances = np.where(np.isnan(tolerances), 1e-4, tolerances)
+    if callback is None:
+        scaledCallback = None
+    else:
+
+        def scaledCallback(scaledX):
+            callback(scaledX * tolerances)
+
+    result = minimize(
+        lambda scaledX: titration.optimisationFuncLog(scaledX * tolerances),
+        x0=start / tolerances,
+        method="nelder-mead",
+        callback=scaledCallback,
+        options={"xatol": 1},
+    )
+    result.x = result.x * tolerances
+    return result
+
+
+# The copy of the titration used for the local fits in each worker process of
+# OptimiserMultiStart, which only needs to be sent to the process once.
+workerTitration = None
+
+
+def initialiseWorker(titration):
+    global workerTitration
+    workerTitration = titration
+    titration.plan = ModelPlan(titration)
+    titration.evaluationCache = OrderedDict()
+
+
+def localFitInWorker(start):
+    result = localFit(workerTitration, start)
+    return result.x, result.fun, result.nfev
+
+
+class MultiStartTable(Table):
+    def __init__(self, master, titration):
+        optimiser = titration.optimiser
+        values = [
+            getattr(optimiser, "startCount", OptimiserMultiStart.startCount),
+            getattr(optimiser, "logKRange", OptimiserMultiStart.logKRange),
+        ]
+        super().__init__(
+            master,
+            0,
+            0,
+            ("Value",),
+            rowOptions=("readonlyTitles",),
+            columnOptions=("readonlyTitles",),
+            boldTitles=True,
+        )
+        for name, value in zip(
+            ("Number of starting points", "Range of log₁₀ K (±)"), values
+        ):
+            self.addRow(name, [value])
+
+
+class MultiStartPopup(moduleFrame.Popup):
+    def __init__(self, titration, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.titration = titration
+        self.title("Global search")
+
+        self.frame = ttk.Frame(self)
+        self.frame.pack(expand=True, fill="both")
+
+        startsLabel = ttk.Label(
+            self.frame,
+            text=(
+                "Local fits are started from points spread around the initial guesses"
+                " of log₁₀ K,\nwithin the range entered below."
+            ),
+        )
+        startsLabel.pack()
+
+        self.startsTable = MultiStartTable(self.frame, titration)
+        self.startsTable.pack(expand=True, fill="both")
+
+        buttonFrame = ButtonFrame(self.frame, self.reset, self.saveData, self.destroy)
+        buttonFrame.pack(expand=False, fill="both", side="bottom")
+
+    def reset(self):
+        self.startsTable.data = np.array(
+            [[OptimiserMultiStart.startCount], [OptimiserMultiStart.logKRange]]
+        )
+
+    def saveData(self):
+        startCount, logKRange = self.startsTable.data[:, 0]
+        if np.isnan(startCount) or startCount < 1 or startCount != int(startCount):
+            raise ValueError(
+                "The number of starting points must be a positive integer."
+            )
+        if np.isnan(logKRange) or logKRange < 0:
+            raise ValueError("The range of log₁₀ K must be a nonnegative number.")
+
+        self.startCount = int(startCount)
+        self.logKRange = logKRange
+
+        self.saved = True
+        self.destroy()
+
+
+# Runs Nelder-Mead from many starting points, sampled with a Latin hypercube within
+# logKRange of the initial guess of each log10 K, in parallel worker processes. Stops
+# early once the best solution has been found repeatedly, and stores every distinct
+# minimum found in Titration.localMinima.
+class OptimiserMultiStart(Optimiser):
+    Popup = MultiStartPopup
+    popupAttributes = ("startCount", "logKRange")
+
+    startCount = 16
+    logKRange = 3
+    # Solutions closer than this in every log10 parameter are treated as the same
+    duplicateTolerance = 1e-2
+    repeatsToStop = 3
+    # Below this, the local fits are run in this process, as starting the worker
+    # processes takes longer than a typical fit.
+    minimumStartsForProcesses = 4
+    maxWorkers = None
+    # Interval in seconds at which the callback is called while waiting for the
+    # workers, so that the fit can be cancelled.
+    callbackInterval = 0.2
+
+    def getStarts(self, initialGuess):
+        startCount = int(self.startCount)
+        kCount = self.titration.equilibriumConstants.variableCount
+        starts = np.tile(initialGuess, (startCount, 1))
+        if kCount > 0 and startCount > 1:
+            # The first start is always the initial guess itself.
+            samples = qmc.LatinHypercube(kCount, seed=0).random(startCount - 1)
+            starts[1:, :kCount] += (2 * samples - 1) * self.logKRange
+        return starts
+
+    # Yields the optimum and residuals of each local fit as they finish.
+    def localFits(self, starts, callback):
+        if len(starts) < self.minimumStartsForProcesses:
+            for start in starts:
+                result = localFit(self.titration, start, callback)
+                yield result.x, result.fun
+            return
+
+        # Forking a process with a running Tk interpreter isn't safe.
+        pool = multiprocessing.get_context("spawn").Pool(
+            self.maxWorkers, initialiseWorker, (self.titration,)
+        )
+        budget = self.titration.budget
+        try:
+            results = pool.imap_unordered(localFitInWorker, starts)
+            remaining = len(starts)
+            while remaining > 0:
+                try:
+                    x, residuals, evaluations = results.next(self.callbackInterval)
+                except multiprocessing.TimeoutError:
+                    pass
+                else:
+                    remaining -= 1
+                    yield x, residuals
+                    # The workers don't have the budget, so their evaluations are
+                    # counted here, after their result has been used.
+                    if budget is not None:
+                        budget.spend(evaluations)
+                if budget is not None:
+                    budget.spend(0)
+                if callback is not None:
+                    callback(self.titration.bestFit[1])
+        finally:
+            # Stop the local fits that are still running after stopping early or
+            # being cancelled, rather than letting them finish in the background.
+            pool.terminate()
+
+    def run(self, initialGuess, callback=None):
+        titration = self.titration
+        diagnostics = titration.diagnostics
+        # Each distinct minimum, as [log10 parameters, residuals, times found]
+        minima = []
+        localFits = self.localFits(self.getStarts(initialGuess), callback)
+        try:
+            for x, residuals in localFits:
+                if diagnostics is not None:
+                    diagnostics.count("multiStart.localFits")
+                if residuals < titration.bestFit[0]:
+                    titration.bestFit = (residuals, x)
+
+                for minimum in minima:
+                    if np.all(np.abs(minimum[0] - x) < self.duplicateTolerance):
+                        minimum[2] += 1
+                        if residuals < minimum[1]:
+                            minimum[0], minimum[1] = x, residuals
+                        break
+                else:
+                    minima.append([x, residuals, 1])
+
+                best = min(minima, key=lambda minimum: minimum[1])
+                if best[2] >= self.repeatsToStop:
+                    break
+        finally:
+            localFits.close()
+            minima.sort(key=lambda minimum: minimum[1])
+            titration.localMinima = [tuple(minimum) for minimum in minima]
+            if diagnostics is not None:
+                diagnostics.record("multiStart.distinctMinima", len(minima))
+        return best[0]
+
+
+# Differential evolution over log10 of the Ks and total concentrations, evaluating
+# each generation with a single call to Titration.optimisationFuncLogBatch, after
+# which the best member is polished with Nelder-Mead.
+class OptimiserDifferentialEvolution(Optimiser):
+    # The Ks are searched between the inverses of the total concentrations, and the
+    # unknown total concentrations within their range, widened by this many decades.
+    boundsMargin = 3
+    # Number of members per parameter
+    populationSize = 15
+    maxGenerations = 1000
+    seed = 0
+
+    def getBounds(self, initialGuess):
+        titration = self.titration
+        kCount = titration.equilibriumConstants.variableCount
+        totalConcs = titration.totalConcentrations.run(10 ** initialGuess[kCount:])
+        positiveConcs = totalConcs[totalConcs > 0]
+        if len(positiveConcs) == 0:
+            logConcRange = np.zeros(2)
+        else:
+            logConcRange = np.log10([np.min(positiveConcs), np.max(positiveConcs)])
+
+        margin = np.array([-self.boundsMargin, self.boundsMargin])
+        bounds = np.array(
+            [-logConcRange[::-1] + margin] * kCount
+            + [logConcRange + margin] * (len(initialGuess) - kCount)
+        ).reshape(-1, 2)
+        # Make sure the initial guess is well within the bounds
+        bounds[:, 0] = np.minimum(bounds[:, 0], initialGuess - 1)
+        bounds[:, 1] = np.maximum(bounds[:, 1], initialGuess + 1)
+        return bounds
+
+    def residuals(self, population):
+        residuals = self.titration.optimisationFuncLogBatch(population.T)
+        # Members for which the model can't be evaluated are never selected.
+        return np.where(np.isnan(residuals), np.inf, residuals)
+
+    def run(self, initialGuess, callback=None):
+        if callback is None:
+            generationCallback = None
+        else:
+
+            def generationCallback(x, convergence):
+                callback(x)
+
+        result = differential_evolution(
+            self.residuals,
+            self.getBounds(initialGuess),
+            maxiter=self.maxGenerations,
+            popsize=self.populationSize,
+            seed=self.seed,
+            x0=initialGuess,
+            callback=generationCallback,
+            polish=False,
+            updating="deferred",
+            vectorized=True,
+        )
+        diagnostics = self.titration.diagnostics
+        if diagnostics is not None:
+            # The number of members evaluated is in the batch.populationSize samples.
+            diagnostics.record("differentialEvolution.generations", int(result.nit))
+
+        polished = localFit(self.titration, result.x, callback)
+        if not (result.success and polished.success):
+            self.titration.fitConverged = False
+        return polished.x
+
+
+class ModuleFrame(moduleFrame.ModuleFrame):
+    group = "Fitting"
+    dropdownLabelText = "Optimisation algorithm:"
+    dropdownOptions = {
+        "Nelder-Mead": OptimiserNelderMead,
+        "Levenberg-Marquardt": OptimiserLevenbergMarquardt,
+        "Levenberg-Marquardt with bounds": OptimiserLevenbergMarquardtBounded,
+        "Global search (multi-start Nelder-Mead)": OptimiserMultiStart,
+        "Global search (differential evolution)": OptimiserDifferentialEvolution,
+    }
+    attributeName = "optimiser"
@@ -0,0 +1,30 @@
+import numpy as np
+
+from . import moduleFrame
+
+
+# Floating point type used for the data and the fitting of the spectra during a fit.
+# The speciation is always calculated in double precision, and the final fit at the
+# optimum is repeated in double precision.
+class Precision(moduleFrame.Strategy):
+    requiredAttributes = ("dtype",)
+
+
+class PrecisionDouble(Precision):
+    dtype = np.float64
+
+
+# Halves the memory used by the data and fitted curves, which can speed up fits of
+# very wide spectra.
+class PrecisionSingle(Precision):
+    dtype = np.float32
+
+
+class ModuleFrame(moduleFrame.ModuleFrame):
+    group = "Fitting"
+    dropdownLabelText = "Precision of the fitted spectra:"
+    dropdownOptions = {
+        "Double (64-bit)": PrecisionDouble,
+        "Single (32-bit)": PrecisionSingle,
+    }
+    attributeName = "precision"
@@ -4,6 +4,7 @@ import numpy as np
 from numpy import ma
 
 from . import moduleFrame
+from .modelPlan import moleculeSumMatrix
 
 
 class Proportionality(moduleFrame.Strategy):
@@ -21,15 +22,30 @@ class GetConcs(Proportionality):
 
 class GetFraction(Proportionality):
     def run(self, contributorConcs, contributorsCountPerMolecule):
-        splitIndices = np.cumsum(contributorsCountPerMolecule, axis=-1)[:-1]
-        concsPerMolecule = np.hsplit(contributorConcs, splitIndices)
-        proportionalConcs = np.hstack(
-            [
-                concs / np.sum(concs, axis=-1, keepdims=True)
-                for concs in concsPerMolecule
-            ]
+        # Sum the concentrations of the contributors from each molecule with a single
+        # matrix product, then divide each by the sum for its molecule. The matrix is
+        # built once by ContributorsPlan, unless it is for different contributors.
+        plan = self.titration.contributors.plan
+        if np.array_equal(
+            plan.contributorsCountPerMolecule, contributorsCountPerMolecule
+        ):
+            moleculeIndices, moleculeMatrix = plan.moleculeIndices, plan.moleculeMatrix
+        else:
+            moleculeIndices, moleculeMatrix = moleculeSumMatrix(
+                contributorsCountPerMolecule
+            )
+        concs = ma.getdata(contributorConcs)
+        totals = (concs @ moleculeMatrix)[..., moleculeIndices]
+
+        proportionalConcs = np.empty(concs.shape)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.divide(concs, totals, out=proportionalConcs)
+
+        # Masked wherever a molecule has a total concentration of zero
+        return ma.masked_array(
+            proportionalConcs,
+            ~np.isfinite(proportionalConcs) | ma.getmaskarray(contributorConcs),
         )
-        return ma.masked_invalid(proportionalConcs)
 
 
 class ModuleFrame(moduleFrame.ModuleFrame):
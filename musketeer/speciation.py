@@ -1,12 +1,14 @@
 import tkinter.ttk as ttk
 import warnings
 from abc import abstractmethod
+from collections import OrderedDict
 
 import numpy as np
 from numpy import ma
 from scipy.optimize import minimize
 
 from . import moduleFrame
+from .modelPlan import SpeciationPlan
 from .scrolledFrame import ScrolledFrame
 from .style import padding
 from .table import ButtonFrame, Table, WrappedLabel
@@ -37,6 +39,102 @@ def stoichiometriesToBoundNames(freeNames, stoichiometries):
     return np.array(boundNames)
 
 
+# Returns Ks * np.prod(concs ** M, axis=-1) for each row of M, broadcasting over the
+# leading axes of concs. This is computed in the log domain as a single matmul, which
+# avoids overflow and underflow of the individual powers when the Ks are very large.
+def powerProducts(concs, M, Ks):
+    zeroConcs = concs == 0
+    if not zeroConcs.any():
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.exp(np.log(concs) @ M.T + np.log(Ks))
+
+    # 0 ** 0 == 1, so only the rows of M that contain a component with a
+    # concentration of 0 give a product of 0.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        logConcs = np.where(zeroConcs, 0, np.log(concs))
+        products = np.exp(logConcs @ M.T + np.log(Ks))
+    return np.where(zeroConcs @ (M.T != 0), 0, products)
+
+
+# Both roots of a * x**2 + b * x + c, avoiding cancellation between b and the square
+# root of the discriminant. Complex roots are returned as NaN.
+def quadraticRoots(a, b, c):
+    h = -(b + np.copysign(np.sqrt(b**2 - 4 * a * c), b)) / 2
+    return np.stack([h / a, c / h], axis=-1)
+
+
+# Smallest positive real root of a * x**3 + b * x**2 + c * x + d, for each element of
+# the broadcast coefficient arrays, or NaN if there isn't one below maximum. The root
+# of largest magnitude is found using the trigonometric method when there are three
+# real roots, and Cardano's formula otherwise, as the other two roots can suffer from
+# severe cancellation. Those are then found by deflating to a quadratic.
+def smallestPositiveCubicRoots(a, b, c, d, maximum=np.inf, polishingSteps=2):
+    a, b, c, d, maximum = np.broadcast_arrays(a, b, c, d, maximum)
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        # Normalise and convert to the depressed cubic t**3 + p * t + q, x = t - B / 3
+        B, C, D = b / a, c / a, d / a
+        p = C - B**2 / 3
+        q = 2 * B**3 / 27 - B * C / 3 + D
+        discriminant = (q / 2) ** 2 + (p / 3) ** 3
+
+        m = 2 * np.sqrt(-p / 3)
+        theta = np.arccos(np.clip(3 * q / (p * m), -1, 1)) / 3
+        trigonometricRoots = (
+            m[..., np.newaxis]
+            * np.cos(theta[..., np.newaxis] - 2 * np.pi * np.arange(3) / 3)
+            - B[..., np.newaxis] / 3
+        )
+        largestTrigonometricRoot = np.take_along_axis(
+            trigonometricRoots,
+            np.argmax(np.abs(trigonometricRoots), axis=-1)[..., np.newaxis],
+            axis=-1,
+        )[..., 0]
+
+        u = np.cbrt(-q / 2 - np.copysign(np.sqrt(discriminant), q))
+        cardanoRoot = np.where(u == 0, 0, u - p / (3 * u)) - B / 3
+
+        largestRoot = np.where(discriminant < 0, largestTrigonometricRoot, cardanoRoot)
+        cubicRoots = np.concatenate(
+            [
+                largestRoot[..., np.newaxis],
+                quadraticRoots(1, B + largestRoot, -D / largestRoot),
+            ],
+            axis=-1,
+        )
+
+        # When a == 0, solve b * x**2 + c * x + d = 0 instead, or c * x + d = 0 if
+        # b == 0 too.
+        noRoot = np.full(d.shape + (1,), np.nan)
+        linearRoots = np.concatenate([(-d / c)[..., np.newaxis], noRoot], axis=-1)
+        roots = np.where(
+            (a != 0)[..., np.newaxis],
+            cubicRoots,
+            np.concatenate(
+                [
+                    np.where(
+                        (b != 0)[..., np.newaxis],
+                        quadraticRoots(b, c, d),
+                        linearRoots,
+                    ),
+                    noRoot,
+                ],
+                axis=-1,
+            ),
+        )
+
+        valid = (roots > 0) & (roots <= maximum[..., np.newaxis])
+        roots = np.min(np.where(valid, roots, np.inf), axis=-1)
+        roots = np.where(np.isinf(roots), np.nan, roots)
+
+        # Correct for rounding errors in the closed-form solutions
+        for _ in range(polishingSteps):
+            value = ((a * roots + b) * roots + c) * roots + d
+            derivative = (3 * a * roots + 2 * b) * roots + c
+            correction = value / derivative
+            roots = np.where(np.isfinite(correction), roots - correction, roots)
+    return roots
+
+
 class ComplexSpeciationMixin:
     @property
     def complexIndices(self):
@@ -58,21 +156,36 @@ class ComplexSpeciationMixin:
 
     complexOutputStoichiometries = complexStoichiometries
 
+    # The functions below accept either a single row of free concentrations, or an
+    # array with one row per addition, and broadcast over the leading axes.
     def complexFreeToBoundConcs(self, freeConcs, complexKs):
-        return complexKs * np.prod(freeConcs**self.complexStoichiometries, axis=1)
+        return powerProducts(freeConcs, self.plan.complexStoichiometries, complexKs)
 
     def complexObjective(self, free, complexKs, total, M):
-        return complexKs @ np.prod(free**M, 1)
+        return np.sum(powerProducts(free, M, complexKs), axis=-1)
 
     def complexJacobian(self, free, complexKs, total, M):
-        return M.T @ (complexKs * np.prod(free**M, 1))
+        return powerProducts(free, M, complexKs) @ M
 
     def complexHessian(self, free, complexKs, total, M):
-        return M.T @ (M * np.outer(complexKs * np.prod(free**M, 1), 1 / free))
+        bound = powerProducts(free, M, complexKs)
+        return (M.T * bound[..., np.newaxis, :]) @ M / free[..., np.newaxis, :]
 
     def complexGetUpperBounds(self, complexKs, total, M):
         return total
 
+    # Partial derivatives at constant free concentrations, for each addition, of the
+    # mass balance residuals (free + bound - total) with respect to log(complexKs),
+    # and of the complex concentrations with respect to log(complexKs) and log(free).
+    def complexSensitivities(self, free, complexKs, complexConcs):
+        M = self.plan.complexStoichiometries
+        complexCount = M.shape[0]
+        residualByLogKs = M.T * complexConcs[:, np.newaxis, :]
+        outputsByLogKs = np.zeros(complexConcs.shape + (complexCount,))
+        outputsByLogKs[:, range(complexCount), range(complexCount)] = complexConcs
+        outputsByLogFree = complexConcs[:, :, np.newaxis] * M
+        return residualByLogKs, outputsByLogKs, outputsByLogFree
+
 
 class PolymerSpeciationMixin:
     @property
@@ -123,16 +236,13 @@ class PolymerSpeciationMixin:
         return outputStoichiometries
 
     def splitPolymerKs(self, polymerKs):
-        k2s = np.zeros(self.freeCount)
-        kns = np.zeros(self.freeCount)
-        kabs = np.ones(self.polymerCount)
-        ks = list(polymerKs)
-        for polymerIndex, row in enumerate(self.polymerStoichiometries):
-            freeIndex = np.where(row < 0)[0][0]
-            if np.count_nonzero(row) == 1:
-                k2s[freeIndex], kns[freeIndex] = ks.pop(0), ks.pop(0)
-            else:
-                kabs[polymerIndex] = ks.pop(0)
+        plan = self.plan
+        k2s = np.zeros(plan.freeCount)
+        kns = np.zeros(plan.freeCount)
+        kabs = np.ones(plan.polymerCount)
+        k2s[plan.k2Components] = polymerKs[plan.k2Positions]
+        kns[plan.knComponents] = polymerKs[plan.knPositions]
+        kabs[plan.kabsPolymers] = polymerKs[plan.kabsPositions]
         return k2s, kns, kabs
 
     def getTerminalInternalConcs(self, freeConcs, k2s, kns, kabs):
@@ -145,27 +255,14 @@ class PolymerSpeciationMixin:
         # that end-capped polymers can be treated as if they're regular complexes.
         terminal = 2 * freeConcs**2 * k2s / (1 - freeConcs * kns)
         internal = freeConcs**3 * k2s * kns / (1 - freeConcs * kns) ** 2
-        componentConcs = np.concatenate([freeConcs, terminal, internal])
-
-        freeCount = self.freeCount
-        polymerCount = self.polymerCount
+        componentConcs = np.concatenate([freeConcs, terminal, internal], axis=-1)
 
-        # split end group (pos) and polymer (neg) stoichiometries
-        pos = np.where(self.polymerStoichiometries < 0, 0, self.polymerStoichiometries)
-        neg = np.where(
-            self.polymerStoichiometries < 0, np.abs(self.polymerStoichiometries), 0
+        # Each polymer gives two outputs: terminal and internal. See
+        # SpeciationPlan.fullPolymerStoichiometries.
+        return powerProducts(
+            componentConcs, self.plan.fullPolymerStoichiometries, np.repeat(kabs, 2)
         )
 
-        # each polymer gives two outputs: terminal and internal
-        fullStoichiometries = np.zeros([polymerCount * 2, freeCount * 3])
-
-        # terminal and internal states both require end cap concentrations
-        fullStoichiometries[::2, :freeCount] = pos
-        fullStoichiometries[1::2, :freeCount] = pos
-        fullStoichiometries[::2, freeCount : freeCount * 2] = neg
-        fullStoichiometries[1::2, freeCount * 2 :] = neg
-        return np.repeat(kabs, 2) * np.prod(componentConcs**fullStoichiometries, axis=1)
-
     def polymerFreeExactSolutionSingle(self, k2, kn, totalSingle):
         roots = np.roots(
             [
@@ -179,56 +276,203 @@ class PolymerSpeciationMixin:
         return np.min(real_roots[real_roots > 0])
 
     def polymerFreeExactSolution(self, k2s, kns, total):
-        return np.array(
-            [
-                self.polymerFreeExactSolutionSingle(k2, kn, totalSingle)
-                for k2, kn, totalSingle in zip(k2s, kns, total)
-            ]
+        k2s, kns, total = np.broadcast_arrays(k2s, kns, total)
+        solution = smallestPositiveCubicRoots(
+            k2s * kns - kns**2,
+            total * kns**2 + 2 * kns - 2 * k2s,
+            -1 - 2 * total * kns,
+            total,
+            # The polymer concentration diverges as free approaches 1 / kn. Allow
+            # for rounding errors in the roots.
+            np.minimum(
+                total,
+                np.divide(1, kns, out=np.full(total.shape, np.inf), where=kns > 0),
+            )
+            * (1 + 1e-9),
+        ).reshape(-1)
+        # Fall back to np.roots if the closed-form solution failed
+        for i in np.flatnonzero(~np.isfinite(solution)):
+            solution[i] = self.polymerFreeExactSolutionSingle(
+                k2s.flat[i], kns.flat[i], total.flat[i]
+            )
+        return solution.reshape(total.shape)
+
+    # kabs * np.prod(free ** pos * polymerFactors ** neg, axis=-1) for each polymer,
+    # where pos are the end group stoichiometries and neg the polymer stoichiometries.
+    def polymerProducts(self, free, polymerFactors, kabs, M):
+        pos = np.where(M < 0, 0, M)
+        neg = np.where(M < 0, np.abs(M), 0)
+        return powerProducts(
+            np.concatenate(np.broadcast_arrays(free, polymerFactors), axis=-1),
+            np.concatenate([pos, neg], axis=-1),
+            kabs,
         )
 
     def polymerObjective(self, free, k2s, kns, kabs, total, M):
-        if self.polymerCount == 0:
+        if M.shape[0] == 0:
             return 0.0
-        pos = np.where(M < 0, 0, M)
-        neg = np.where(M < 0, np.abs(M), 0)
         polymerWithoutFactorOfN = free**2 * k2s / (1 - free * kns)
-
-        polymerIntegral = kabs @ np.prod(
-            free**pos * polymerWithoutFactorOfN**neg, axis=1
+        return np.sum(
+            self.polymerProducts(free, polymerWithoutFactorOfN, kabs, M), axis=-1
         )
-        return np.sum(polymerIntegral)
 
     def polymerJacobian(self, free, k2s, kns, kabs, total, M):
-        if self.polymerCount == 0:
-            return np.full(len(free), 0.0)
+        if M.shape[0] == 0:
+            return np.zeros_like(free)
 
         pos = np.where(M < 0, 0, M)
         neg = np.where(M < 0, np.abs(M), 0)
-        polymerWithFactorOfN = free**2 * k2s * (2 - free * kns) / (1 - free * kns) ** 2
+        polymerWithFactorOfN = (
+            free**2 * k2s * (2 - free * kns) / (1 - free * kns) ** 2
+        )
         polymerWithoutFactorOfN = free**2 * k2s / (1 - free * kns)
-        polymerConcentration = neg.T @ (
-            kabs * np.prod(free**pos * polymerWithFactorOfN**neg, axis=1)
+        polymerConcentration = (
+            self.polymerProducts(free, polymerWithFactorOfN, kabs, M) @ neg
         )
-        endCapConcentration = pos.T @ (
-            kabs * np.prod(free**pos * polymerWithoutFactorOfN**neg, axis=1)
+        endCapConcentration = (
+            self.polymerProducts(free, polymerWithoutFactorOfN, kabs, M) @ pos
         )
         return polymerConcentration + endCapConcentration
 
+    def polymerHessian(self, free, k2s, kns, kabs, total, M):
+        # Derivative of polymerJacobian with respect to the free concentrations.
+        if M.shape[0] == 0:
+            return np.zeros(free.shape + free.shape[-1:])
+
+        pos = np.where(M < 0, 0, M)
+        neg = np.where(M < 0, np.abs(M), 0)
+        polymerWithFactorOfN = (
+            free**2 * k2s * (2 - free * kns) / (1 - free * kns) ** 2
+        )
+        polymerWithoutFactorOfN = free**2 * k2s / (1 - free * kns)
+        endCaps = self.polymerProducts(free, polymerWithoutFactorOfN, kabs, M)
+        polymers = self.polymerProducts(free, polymerWithFactorOfN, kabs, M)
+        # logarithmic derivatives of polymerWithoutFactorOfN and polymerWithFactorOfN
+        dLogWithout = (2 - free * kns) / (1 - free * kns)
+        dLogWith = 2 - free * kns / (2 - free * kns) + 2 * free * kns / (1 - free * kns)
+        endCapHessian = (pos.T * endCaps[..., np.newaxis, :]) @ (
+            pos + neg * dLogWithout[..., np.newaxis, :]
+        )
+        polymerHessian = (neg.T * polymers[..., np.newaxis, :]) @ (
+            pos + neg * dLogWith[..., np.newaxis, :]
+        )
+        return (endCapHessian + polymerHessian) / free[..., np.newaxis, :]
+
+    # Partial derivatives at constant free concentrations, for each addition, of the
+    # mass balance residuals (free + bound - total) with respect to the log of each
+    # polymer K, in the order they appear in the variables, and of the terminal and
+    # internal concentrations with respect to log(polymer Ks) and log(free).
+    def polymerSensitivities(self, free, k2s, kns, kabs, polymerConcs):
+        plan = self.plan
+        pos, neg = plan.polymerPos, plan.polymerNeg
+        numPoints = free.shape[0]
+        variableCount = len(plan.k2Positions) * 2 + len(plan.kabsPositions)
+
+        residualByLogKs = np.zeros((numPoints, plan.freeCount, variableCount))
+        outputsByLogKs = np.zeros(polymerConcs.shape + (variableCount,))
+        outputsByLogFree = np.zeros(polymerConcs.shape + (plan.freeCount,))
+        if plan.polymerCount == 0:
+            return residualByLogKs, outputsByLogKs, outputsByLogFree
+
+        freeKns = free * kns
+        polymerWithFactorOfN = free**2 * k2s * (2 - freeKns) / (1 - freeKns) ** 2
+        polymerWithoutFactorOfN = free**2 * k2s / (1 - freeKns)
+        polymerM = plan.polymerStoichiometries
+        endCaps = self.polymerProducts(free, polymerWithoutFactorOfN, kabs, polymerM)
+        polymers = self.polymerProducts(free, polymerWithFactorOfN, kabs, polymerM)
+        endCapsByNeg = pos.T * endCaps[:, np.newaxis, :]
+        polymersByNeg = neg.T * polymers[:, np.newaxis, :]
+
+        # Logarithmic derivatives with respect to kn of polymerWithoutFactorOfN and
+        # polymerWithFactorOfN, and of the terminal and internal concentrations.
+        dLogWithoutByLogKn = freeKns / (1 - freeKns)
+        dLogWithByLogKn = 2 * freeKns / (1 - freeKns) - freeKns / (2 - freeKns)
+        dLogTerminalByLogKn = freeKns / (1 - freeKns)
+        dLogInternalByLogKn = 1 + 2 * freeKns / (1 - freeKns)
+
+        # The polymer concentration of each component is proportional to k2
+        residualByLogK2s = (polymersByNeg + endCapsByNeg) @ neg
+        residualByLogKns = polymersByNeg @ (
+            neg * dLogWithByLogKn[:, np.newaxis, :]
+        ) + endCapsByNeg @ (neg * dLogWithoutByLogKn[:, np.newaxis, :])
+        residualByLogKabs = polymersByNeg + endCapsByNeg
+
+        residualByLogKs[:, :, plan.k2Positions] = residualByLogK2s[
+            :, :, plan.k2Components
+        ]
+        residualByLogKs[:, :, plan.knPositions] = residualByLogKns[
+            :, :, plan.knComponents
+        ]
+        residualByLogKs[:, :, plan.kabsPositions] = residualByLogKabs[
+            :, :, plan.kabsPolymers
+        ]
+
+        terminal = polymerConcs[:, ::2, np.newaxis]
+        internal = polymerConcs[:, 1::2, np.newaxis]
+        outputsByLogK2s = np.zeros(polymerConcs.shape + (plan.freeCount,))
+        outputsByLogK2s[:, ::2] = terminal * neg
+        outputsByLogK2s[:, 1::2] = internal * neg
+        outputsByLogKns = np.zeros(polymerConcs.shape + (plan.freeCount,))
+        outputsByLogKns[:, ::2] = terminal * neg * dLogTerminalByLogKn[:, np.newaxis]
+        outputsByLogKns[:, 1::2] = internal * neg * dLogInternalByLogKn[:, np.newaxis]
+
+        outputsByLogKs[:, :, plan.k2Positions] = outputsByLogK2s[
+            :, :, plan.k2Components
+        ]
+        outputsByLogKs[:, :, plan.knPositions] = outputsByLogKns[
+            :, :, plan.knComponents
+        ]
+        outputsByLogKs[:, 2 * plan.kabsPolymers, plan.kabsPositions] = polymerConcs[
+            :, 2 * plan.kabsPolymers
+        ]
+        outputsByLogKs[:, 2 * plan.kabsPolymers + 1, plan.kabsPositions] = polymerConcs[
+            :, 2 * plan.kabsPolymers + 1
+        ]
+
+        dLogTerminalByLogFree = 2 + freeKns / (1 - freeKns)
+        dLogInternalByLogFree = 3 + 2 * freeKns / (1 - freeKns)
+        outputsByLogFree[:, ::2] = terminal * (
+            pos + neg * dLogTerminalByLogFree[:, np.newaxis, :]
+        )
+        outputsByLogFree[:, 1::2] = internal * (
+            pos + neg * dLogInternalByLogFree[:, np.newaxis, :]
+        )
+        return residualByLogKs, outputsByLogKs, outputsByLogFree
+
     def polymerGetUpperBounds(self, k2s, kns, kabs, total, M):
-        if self.polymerCount == 0:
+        if M.shape[0] == 0:
             return np.inf
-        return np.where(
-            self.polymerIndices, self.polymerFreeExactSolution(k2s, kns, total), np.inf
-        )
+        # Components that don't polymerise have k2 = kn = 0, giving a solution of
+        # free = total.
+        return self.polymerFreeExactSolution(k2s, kns, total)
 
 
 class Speciation(ComplexSpeciationMixin, PolymerSpeciationMixin, moduleFrame.Strategy):
     requiredAttributes = ("stoichiometries",)
 
+    # The SpeciationPlan used outside of a fit isn't copied with the strategy, as it
+    # can be rebuilt from the stoichiometries.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("planCache", None)
+        return state
+
     @abstractmethod
     def run(self, variables, totalConcs):
         pass
 
+    # The output of run for each row of variablesBatch, with the corresponding total
+    # concentrations, as an array of shape (population, additions, species).
+    # Subclasses whose run broadcasts over the population can override this to call
+    # it directly.
+    def runBatch(self, variablesBatch, totalConcsBatch):
+        return np.array(
+            [
+                self.run(variables, totalConcs)
+                for variables, totalConcs in zip(variablesBatch, totalConcsBatch)
+            ]
+        )
+
     # Other modules need to access freeNames and freeCount, but totalConcentrations
     # may not yet be loaded.
     @property
@@ -270,6 +514,23 @@ class Speciation(ComplexSpeciationMixin, PolymerSpeciationMixin, moduleFrame.Str
             ]
         )
 
+    # The frozen SpeciationPlan compiled by Titration.optimise(). Outside of a fit,
+    # one is built and reused until the stoichiometries change, as it is needed by
+    # several methods in every evaluation.
+    @property
+    def plan(self):
+        modelPlan = getattr(self.titration, "plan", None)
+        if modelPlan is not None and modelPlan.speciation.source is self:
+            return modelPlan.speciation
+        stoichiometries = np.asarray(self.stoichiometries)
+        key = (stoichiometries.dtype.str, stoichiometries.shape)
+        key += (stoichiometries.tobytes(),)
+        cache = getattr(self, "planCache", None)
+        if cache is None or cache[0] != key:
+            cache = (key, SpeciationPlan(self))
+            self.planCache = cache
+        return cache[1]
+
     @property
     def formsBinaryComplex(self):
         # polymers include dimers, so treat as a dimer
@@ -312,21 +573,124 @@ class Speciation(ComplexSpeciationMixin, PolymerSpeciationMixin, moduleFrame.Str
         return result
 
     def variablesToKs(self, variables):
-        complexKs = variables[: self.complexCount]
-        polymerKs = variables[self.complexCount :]
+        complexCount = self.plan.complexCount
+        complexKs = variables[:complexCount]
+        polymerKs = variables[complexCount:]
         k2s, kns, kabs = self.splitPolymerKs(polymerKs)
         return complexKs, k2s, kns, kabs
 
     # TODO: rewrite all non-mixin functions to be agnostic to the components of
     # polymerKs, by just working with complexKs and polymerKs, or possibly *polymerKs
     def freeToBoundConcs(self, freeConcs, complexKs, k2s, kns, kabs):
-        return np.hstack(
+        return np.concatenate(
             [
                 self.complexFreeToBoundConcs(freeConcs, complexKs),
                 self.polymerFreeToBoundConcs(freeConcs, k2s, kns, kabs),
-            ]
+            ],
+            axis=-1,
         )
 
+    # Sensitivities of the species concentrations returned by run(), found by implicit
+    # differentiation of the mass balance equations at the solution. Returns the
+    # derivatives with respect to log10 of each of the variables, with shape
+    # (additions, outputs, variables), and with respect to each of the total
+    # concentrations, with shape (additions, outputs, components). Derivatives with
+    # respect to a total concentration of 0 are NaN.
+    def sensitivities(self, variables, totalConcs, speciesConcs=None):
+        variables = np.asarray(variables, dtype=float)
+        totalConcs = np.asarray(totalConcs, dtype=float)
+        if speciesConcs is None:
+            speciesConcs = self.run(variables, totalConcs)
+        speciesConcs = np.asarray(speciesConcs)
+
+        plan = self.plan
+        freeCount = plan.freeCount
+        complexCount = plan.complexCount
+        complexKs, k2s, kns, kabs = self.variablesToKs(variables)
+        free = speciesConcs[:, :freeCount]
+        complexConcs = speciesConcs[:, freeCount : freeCount + complexCount]
+        polymerConcs = speciesConcs[:, freeCount + complexCount :]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            complexTerms = self.complexSensitivities(free, complexKs, complexConcs)
+            polymerTerms = self.polymerSensitivities(free, k2s, kns, kabs, polymerConcs)
+        residualByLogVariables = np.concatenate(
+            [complexTerms[0], polymerTerms[0]], axis=-1
+        )
+        outputsByLogVariables = np.concatenate(
+            [
+                np.zeros(free.shape + (len(variables),)),
+                np.concatenate(
+                    [
+                        complexTerms[1],
+                        np.zeros(complexConcs.shape + (polymerTerms[1].shape[-1],)),
+                    ],
+                    axis=-1,
+                ),
+                np.concatenate(
+                    [
+                        np.zeros(polymerConcs.shape + (complexCount,)),
+                        polymerTerms[1],
+                    ],
+                    axis=-1,
+                ),
+            ],
+            axis=1,
+        )
+        freeByLogFree = np.zeros(free.shape + (freeCount,))
+        freeByLogFree[:, range(freeCount), range(freeCount)] = free
+        outputsByLogFree = np.concatenate(
+            [freeByLogFree, complexTerms[2], polymerTerms[2]], axis=1
+        )
+
+        outputsByTotals = np.full(outputsByLogFree.shape, np.nan)
+        zeroFreePatterns, patternIndices = np.unique(
+            totalConcs == 0, axis=0, return_inverse=True
+        )
+        for patternIndex, zeroFree in enumerate(zeroFreePatterns):
+            points = np.where(patternIndices.reshape(-1) == patternIndex)[0]
+            pattern = plan.getZeroPattern(zeroFree)
+            nonzeroFree = pattern.nonzeroFree
+            if not np.any(nonzeroFree):
+                continue
+
+            # Jacobian of the residuals with respect to log(free)
+            filteredFree = free[points][:, nonzeroFree]
+            hessian = (
+                self.complexHessian(
+                    filteredFree,
+                    complexKs[pattern.complexFilter],
+                    None,
+                    pattern.complexStoichiometries,
+                )
+                + self.polymerHessian(
+                    filteredFree,
+                    k2s[nonzeroFree],
+                    kns[nonzeroFree],
+                    kabs[pattern.polymerFilter],
+                    None,
+                    pattern.polymerStoichiometries,
+                )
+            ) * filteredFree[:, np.newaxis, :]
+            diagonal = np.arange(filteredFree.shape[-1])
+            hessian[:, diagonal, diagonal] += filteredFree
+            logFreeByTotals = np.linalg.inv(hessian)
+
+            # The residuals stay at 0: d residual = H d log(free) + d residual/d x = 0
+            outputsByFilteredLogFree = outputsByLogFree[points][:, :, nonzeroFree]
+            outputsByLogVariables[points] -= (
+                outputsByFilteredLogFree
+                @ logFreeByTotals
+                @ residualByLogVariables[points][:, nonzeroFree, :]
+            )
+            patternOutputsByTotals = outputsByTotals[points]
+            patternOutputsByTotals[:, :, nonzeroFree] = (
+                outputsByFilteredLogFree @ logFreeByTotals
+            )
+            outputsByTotals[points] = patternOutputsByTotals
+
+        return outputsByLogVariables * LN_10, outputsByTotals
+
 
 class SpeciationTable(Table):
     def __init__(self, master, titration):
@@ -478,12 +842,16 @@ class SpeciationDimerisation(Speciation):
         M.resize([1, self.freeCount])
         return M
 
+    # Broadcasts over any leading dimensions of variables and totalConcs
     def run(self, variables, totalConcs):
-        K = variables[0]
-        Htot = totalConcs.T[0]
+        K = variables[..., 0, np.newaxis]
+        Htot = totalConcs[..., 0]
         H = (-1 + np.sqrt(1 + 8 * Htot * K)) / (4 * K)
         H2 = (1 + 4 * Htot * K - np.sqrt(1 + 8 * Htot * K)) / (8 * K)
-        return np.array([H, H2]).T
+        return np.stack([H, H2], axis=-1)
+
+    def runBatch(self, variablesBatch, totalConcsBatch):
+        return self.run(variablesBatch, totalConcsBatch)
 
 
 class SpeciationHG(Speciation):
@@ -493,9 +861,10 @@ class SpeciationHG(Speciation):
         M.resize([1, self.freeCount])
         return M
 
+    # Broadcasts over any leading dimensions of variables and totalConcs
     def run(self, variables, totalConcs):
-        K = variables[0]
-        Htot, Gtot = totalConcs.T
+        K = variables[..., 0, np.newaxis]
+        Htot, Gtot = np.moveaxis(totalConcs, -1, 0)
         H = (
             np.sqrt(
                 Gtot**2 * K**2 - 2 * Gtot * K * (Htot * K - 1) + (Htot * K + 1) ** 2
@@ -514,7 +883,10 @@ class SpeciationHG(Speciation):
         ) / (2 * K)
         HG = H * G * K
 
-        return np.array([H, G, HG]).T
+        return np.stack([H, G, HG], axis=-1)
+
+    def runBatch(self, variablesBatch, totalConcsBatch):
+        return self.run(variablesBatch, totalConcsBatch)
 
 
 # Old, slower speciation algorithm, currently unused. Left in in case results need to
@@ -593,8 +965,8 @@ class SpeciationSolver(Speciation):
     ):
         free = 10 ** (logFreeTimesTotal / total)
         return (
-            np.sum(free)
-            - np.sum(logFreeTimesTotal) * LN_10
+            np.sum(free, axis=-1)
+            - np.sum(logFreeTimesTotal, axis=-1) * LN_10
             + self.complexObjective(free, complexKs, total, complexM)
             + self.polymerObjective(free, k2s, kns, kabs, total, polymerM)
         )
@@ -619,8 +991,8 @@ class SpeciationSolver(Speciation):
     ):
         free = 10 ** (logFreeTimesTotal / self.scaling_factor / total)
         return (
-            np.sum(free)
-            - np.sum(logFreeTimesTotal / self.scaling_factor) * LN_10
+            np.sum(free, axis=-1)
+            - np.sum(logFreeTimesTotal / self.scaling_factor, axis=-1) * LN_10
             + self.complexObjective(free, complexKs, total, complexM)
             + self.polymerObjective(free, k2s, kns, kabs, total, polymerM)
         ) * self.scaling_factor
@@ -640,11 +1012,20 @@ class SpeciationSolver(Speciation):
             / total
         )
 
+    # Truncation events are counted if diagnostics are being recorded, and printed
+    # otherwise.
+    def recordTruncation(self, function):
+        diagnostics = getattr(self.titration, "diagnostics", None)
+        if diagnostics is None:
+            print(f"used truncation in {function}")
+        else:
+            diagnostics.count(f"speciation.truncation.{function}")
+
     def smoothObjective(self, logFreeTimesTotal, *args, **kwargs):
         upperBounds = self.getDomainUpperBounds(*args, **kwargs)
         if np.all(logFreeTimesTotal <= upperBounds):
             return self.objective(logFreeTimesTotal, *args, **kwargs)
-        print("used truncation in objective")
+        self.recordTruncation("objective")
 
         truncatedX = np.clip(logFreeTimesTotal, None, upperBounds)
         return self.objective(truncatedX, *args, **kwargs) + np.sum(
@@ -656,7 +1037,7 @@ class SpeciationSolver(Speciation):
         upperBounds = self.getDomainUpperBounds(*args, **kwargs)
         if np.all(logFreeTimesTotal <= upperBounds):
             return self.jacobian(logFreeTimesTotal, *args, **kwargs)
-        print("used truncation in jacobian")
+        self.recordTruncation("jacobian")
 
         truncatedX = np.clip(logFreeTimesTotal, None, upperBounds)
         return self.jacobian(truncatedX, *args, **kwargs)
@@ -668,65 +1049,385 @@ class SpeciationSolver(Speciation):
             self.polymerGetUpperBounds(k2s, kns, kabs, total, polymerM),
         )
 
+    def getFreeBounds(self, complexKs, k2s, kns, kabs, total, complexM, polymerM):
+        maxFree = np.minimum(
+            self.complexGetUpperBounds(complexKs, total, complexM),
+            self.polymerGetUpperBounds(k2s, kns, kabs, total, polymerM),
+        )
+        minFree = (total * maxFree) / (
+            maxFree
+            + self.complexJacobian(maxFree, complexKs, total, complexM)
+            + self.polymerJacobian(maxFree, k2s, kns, kabs, total, polymerM)
+        )
+        return minFree, maxFree
+
     # Could be refined iteratively, by computing the LB using this method, then taking
     # UB = self.freeToBoundConcs(free=LB), calculating a new LB using that UB, etc.
-    def getUpperBounds(self, complexKs, k2s, kns, kabs, total, complexM, polymerM):
-        return total * np.log10(
-            np.minimum(
-                self.complexGetUpperBounds(complexKs, total, complexM),
-                self.polymerGetUpperBounds(k2s, kns, kabs, total, polymerM),
-            )
+    def getUpperBounds(self, *args):
+        _, maxFree = self.getFreeBounds(*args)
+        return args[4] * np.log10(maxFree)
+
+    def getLowerBounds(self, *args):
+        minFree, _ = self.getFreeBounds(*args)
+        return args[4] * np.log10(minFree)
+
+    # Maximum number of damped Newton iterations in solveBatch, before any points that
+    # haven't converged are passed to solveSingle.
+    maxNewtonIterations = 50
+    # Maximum change in the natural log of any free concentration in a single step
+    maxLogStep = 5
+    # Maximum relative error in the total concentrations
+    tolerance = 1e-6
+    # Whether solveBatch should find its own initial guesses by continuation along the
+    # titration when none are given, and the number of Newton steps taken at each
+    # addition to correct the predicted free concentrations. Continuation has to step
+    # through the additions one at a time, so is usually slower than solving them all
+    # at once from the lower bounds, but can help if that fails to converge. Like the
+    # settings above, this is for tuning the solver rather than a user option, so is
+    # only changed by setting the attribute.
+    continuation = False
+    continuationCorrectorSteps = 2
+
+    def newtonObjective(self, logFree, complexKs, k2s, kns, kabs, total, *Ms):
+        # Identical to objective(), with the variables in natural log units
+        return self.objective(
+            logFree * total / LN_10, complexKs, k2s, kns, kabs, total, *Ms
         )
 
-    def getLowerBounds(self, complexKs, k2s, kns, kabs, total, complexM, polymerM):
-        maxFree = np.minimum(
-            self.complexGetUpperBounds(complexKs, total, complexM),
-            self.polymerGetUpperBounds(k2s, kns, kabs, total, polymerM),
+    def newtonResidual(
+        self, free, complexKs, k2s, kns, kabs, total, complexM, polymerM
+    ):
+        return (
+            free
+            + self.complexJacobian(free, complexKs, total, complexM)
+            + self.polymerJacobian(free, k2s, kns, kabs, total, polymerM)
+            - total
         )
-        return total * np.log10(
-            (total * maxFree)
-            / (
-                maxFree
-                + self.complexJacobian(maxFree, complexKs, total, complexM)
-                + self.polymerJacobian(maxFree, k2s, kns, kabs, total, polymerM)
+
+    def newtonHessian(self, free, complexKs, k2s, kns, kabs, total, complexM, polymerM):
+        # Derivative of newtonResidual with respect to log(free), which is also the
+        # Hessian of newtonObjective, and is symmetric positive definite.
+        hessian = (
+            self.complexHessian(free, complexKs, total, complexM)
+            + self.polymerHessian(free, k2s, kns, kabs, total, polymerM)
+        ) * free[..., np.newaxis, :]
+        diagonal = np.arange(free.shape[-1])
+        hessian[..., diagonal, diagonal] += free
+        return hessian
+
+    def solveNewtonSystem(self, hessian, rhs):
+        # Scale the Hessian to unit diagonal before solving, as the free
+        # concentrations can span many orders of magnitude.
+        diagonal = np.arange(hessian.shape[-1])
+        scaling = 1 / np.sqrt(hessian[..., diagonal, diagonal])
+        return (
+            scaling
+            * np.linalg.solve(
+                hessian * scaling[..., :, np.newaxis] * scaling[..., np.newaxis, :],
+                (rhs * scaling)[..., np.newaxis],
+            )[..., 0]
+        )
+
+    # Solve every row of total at once, using a damped Newton iteration. The objective
+    # is convex in log(free), with the gradient equal to the error in the total
+    # concentrations. Each step is accepted once it either sufficiently decreases the
+    # objective, or decreases the relative error in the total concentrations, which
+    # remains reliable close to the solution.
+    #
+    # If provided, initialGuess should contain the free concentrations to start from,
+    # otherwise they are found by continuation, or the lower bounds are used. Returns
+    # the natural log of the free concentrations, and a boolean array indicating which
+    # rows have converged.
+    def solveBatch(
+        self,
+        complexKs,
+        k2s,
+        kns,
+        kabs,
+        total,
+        complexM,
+        polymerM,
+        initialGuess=None,
+    ):
+        args = (complexKs, k2s, kns, kabs, total, complexM, polymerM)
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            minFree, maxFree = self.getFreeBounds(*args)
+            if initialGuess is None:
+                initialGuess = minFree
+            else:
+                initialGuess = np.clip(initialGuess, minFree, maxFree)
+        logUpperBounds = np.log(maxFree)
+
+        with np.errstate(divide="ignore"):
+            logFree = np.log(initialGuess)
+        # The lower bound can underflow for very large Ks
+        logFree = np.where(np.isfinite(logFree), logFree, logUpperBounds)
+
+        if self.continuation and initialGuess is minFree and total.shape[0] > 1:
+            logFree = self.continuationGuesses(logFree, logUpperBounds, *args)
+
+        return self.newtonIterations(logFree, logUpperBounds, *args)
+
+    # Predictor-corrector continuation along the titration: starting from the
+    # solution for the first row of total, predict each following row using the
+    # implicit function theorem, d log(free) = H^-1 d total, where H is the Hessian
+    # from newtonHessian(), then refine it with a few Newton steps. Returns the
+    # natural log of the free concentrations, to be used as initial guesses.
+    def continuationGuesses(
+        self, logFree, logUpperBounds, complexKs, k2s, kns, kabs, total, *Ms
+    ):
+        Ks = (complexKs, k2s, kns, kabs)
+        logFree = logFree.copy()
+        logFree[:1], _ = self.newtonIterations(
+            logFree[:1], logUpperBounds[:1], *Ks, total[:1], *Ms
+        )
+
+        def cappedStep(step):
+            largestStep = np.max(np.abs(step))
+            if largestStep > self.maxLogStep:
+                return step * self.maxLogStep / largestStep
+            return step
+
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            for i in range(1, total.shape[0]):
+                try:
+                    # Predictor
+                    hessian = self.newtonHessian(
+                        np.exp(logFree[i - 1]), *Ks, total[i - 1], *Ms
+                    )
+                    step = self.solveNewtonSystem(hessian, total[i] - total[i - 1])
+                    guess = np.minimum(
+                        logFree[i - 1] + cappedStep(step), logUpperBounds[i]
+                    )
+                    if not np.all(np.isfinite(guess)):
+                        continue
+
+                    # Corrector
+                    free = np.exp(guess)
+                    residual = self.newtonResidual(free, *Ks, total[i], *Ms)
+                    error = np.sum((residual / total[i]) ** 2)
+                    for _ in range(self.continuationCorrectorSteps):
+                        step = -self.solveNewtonSystem(
+                            self.newtonHessian(free, *Ks, total[i], *Ms), residual
+                        )
+                        trial = np.minimum(guess + cappedStep(step), logUpperBounds[i])
+                        trialResidual = self.newtonResidual(
+                            np.exp(trial), *Ks, total[i], *Ms
+                        )
+                        trialError = np.sum((trialResidual / total[i]) ** 2)
+                        if not trialError < error:
+                            break
+                        guess, residual, error = trial, trialResidual, trialError
+                        free = np.exp(guess)
+                except np.linalg.LinAlgError:
+                    continue
+                logFree[i] = guess
+        return logFree
+
+    def newtonIterations(
+        self, logFree, logUpperBounds, complexKs, k2s, kns, kabs, total, *Ms
+    ):
+        Ks = (complexKs, k2s, kns, kabs)
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            objective = self.newtonObjective(logFree, *Ks, total, *Ms)
+            residual = self.newtonResidual(np.exp(logFree), *Ks, total, *Ms)
+        error = np.sum((residual / total) ** 2, axis=-1)
+        converged = np.all(np.abs(residual) <= self.tolerance * total, axis=-1)
+        iterations = np.zeros(len(converged), dtype=int)
+
+        for _ in range(self.maxNewtonIterations):
+            if np.all(converged):
+                break
+            active = np.where(~converged)[0]
+            iterations[active] += 1
+
+            free = np.exp(logFree[active])
+            try:
+                step = -self.solveNewtonSystem(
+                    self.newtonHessian(free, *Ks, total[active], *Ms),
+                    residual[active],
+                )
+            except np.linalg.LinAlgError:
+                break
+            slope = np.sum(residual[active] * step, axis=-1)
+            stepSize = np.minimum(1, self.maxLogStep / np.max(np.abs(step), axis=-1))
+
+            # Backtracking line search, separately for each point
+            progress = False
+            for _ in range(30):
+                trial = logFree[active] + stepSize[:, np.newaxis] * step
+                with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+                    trialObjective = self.newtonObjective(
+                        trial, *Ks, total[active], *Ms
+                    )
+                    trialResidual = self.newtonResidual(
+                        np.exp(trial), *Ks, total[active], *Ms
+                    )
+                trialError = np.sum((trialResidual / total[active]) ** 2, axis=-1)
+                accepted = np.all(trial <= logUpperBounds[active], axis=-1) & (
+                    (trialObjective <= objective[active] + 1e-4 * stepSize * slope)
+                    | (trialError < error[active])
+                )
+
+                indices = active[accepted]
+                logFree[indices] = trial[accepted]
+                objective[indices] = trialObjective[accepted]
+                residual[indices] = trialResidual[accepted]
+                error[indices] = trialError[accepted]
+                converged[indices] = np.all(
+                    np.abs(trialResidual[accepted]) <= self.tolerance * total[indices],
+                    axis=-1,
+                )
+                progress |= np.any(accepted)
+
+                active = active[~accepted]
+                if len(active) == 0:
+                    break
+                step = step[~accepted]
+                slope = slope[~accepted]
+                stepSize = stepSize[~accepted] / 2
+
+            if not progress:
+                break
+
+        diagnostics = getattr(self.titration, "diagnostics", None)
+        if diagnostics is not None:
+            diagnostics.addSamples("speciation.newtonIterations", iterations)
+            diagnostics.count(
+                "speciation.newtonFailures", int(np.count_nonzero(~converged))
             )
+        return logFree, converged
+
+    # Solve a single addition using L-BFGS-B, starting from x0.
+    def solveSingle(self, args, x0, lb, ub):
+        # TODO: deal with cases where lb and ub are very close together!
+        # self.scaling_factor = 1000 / min(ub - lb)
+        filteredTotal = args[4]
+        self.scaling_factor = 1000 / np.min(
+            np.abs(filteredTotal * np.log10(filteredTotal))
+        )
+        self.scaling_factor = 1
+
+        result = minimize(
+            self.objectiveScaled,
+            jac=self.jacobianScaled,
+            args=args,
+            x0=x0 * self.scaling_factor,
+            bounds=np.vstack([lb, ub]).T * self.scaling_factor,
+            method="L-BFGS-B",
+            options={
+                "ftol": 0.0,
+                "gtol": 1e-6 * LN_10,
+            },
         )
+        diagnostics = getattr(self.titration, "diagnostics", None)
+        if diagnostics is not None:
+            diagnostics.count("speciation.fallbacks")
+        if max(abs(result.jac)) > 1e-6 * LN_10:
+            if diagnostics is not None:
+                diagnostics.count("speciation.rescaleRetries")
+            self.scaling_factor *= 10_000
+            improvedResult = minimize(
+                self.objectiveScaled,
+                jac=self.jacobianScaled,
+                args=args,
+                x0=result.x,
+                bounds=np.vstack([lb, ub]).T * self.scaling_factor,
+                method="L-BFGS-B",
+                options={
+                    "ftol": 0.0,
+                    "gtol": 1e-6 * LN_10,
+                },
+            )
+            if max(abs(improvedResult.jac)) < max(abs(result.jac)):
+                result = improvedResult
+            else:
+                if diagnostics is not None:
+                    diagnostics.count("speciation.inaccurate")
+                warnings.warn(
+                    "Desired accuracy not achieved in speciation",
+                    RuntimeWarning,
+                )
+
+        # log10 of the free concentrations
+        return result.x / self.scaling_factor / filteredTotal
+
+    # Number of previous solutions to keep, to use as initial guesses for the next
+    # call to run(). Set to 0 to disable.
+    warmStartCacheSize = 8
+
+    def warmStartKey(self, variables, totalConcs):
+        with np.errstate(divide="ignore"):
+            return np.log(np.concatenate([variables, np.ravel(totalConcs)]))
+
+    # Find the cached free concentrations with the nearest Ks and total
+    # concentrations, comparing the largest difference in log units.
+    def getWarmStart(self, key):
+        cache = getattr(self, "warmStartCache", None)
+        if not cache:
+            return None
+
+        bestDistance = np.inf
+        bestEntry = None
+        for entryKey, (cachedKey, _) in cache.items():
+            if cachedKey.shape != key.shape:
+                continue
+            # Avoid inf - inf for Ks and concentrations that are zero in both.
+            with np.errstate(invalid="ignore"):
+                distance = np.max(
+                    np.abs(np.where(cachedKey == key, 0, cachedKey - key)), initial=0
+                )
+            if distance < bestDistance:
+                bestDistance, bestEntry = distance, entryKey
+        if bestEntry is None:
+            return None
+
+        cache.move_to_end(bestEntry)
+        return cache[bestEntry][1]
+
+    def storeWarmStart(self, key, free):
+        if self.warmStartCacheSize <= 0:
+            return
+        if getattr(self, "warmStartCache", None) is None:
+            self.warmStartCache = OrderedDict()
+        self.warmStartCache[key.tobytes()] = (key, free)
+        self.warmStartCache.move_to_end(key.tobytes())
+        while len(self.warmStartCache) > self.warmStartCacheSize:
+            self.warmStartCache.popitem(last=False)
 
     def run(self, variables, totalConcs):
+        variables = np.asarray(variables)
         complexKs, k2s, kns, kabs = self.variablesToKs(variables)
         numPoints = totalConcs.shape[0]
 
-        free = np.empty((numPoints, self.freeCount))
-        bound = np.empty((numPoints, self.outputCount - self.freeCount))
+        free = np.zeros((numPoints, self.freeCount))
+        key = self.warmStartKey(variables, totalConcs)
+        warmStart = self.getWarmStart(key)
 
-        for i in range(numPoints):
-            additionTotalConcs = totalConcs[i]
-
-            # Filter the to exclude species and complexes that will have a concentration
-            # of 0
-            zeroFree = additionTotalConcs == 0
-            zeroBound = np.any(self.stoichiometries[:, zeroFree], axis=1)
-            if all(zeroBound):
-                free[i] = additionTotalConcs
-                bound[i] = 0
+        # Filter to exclude species and complexes that will have a concentration of 0.
+        # Additions with the same components missing are solved together.
+        plan = self.plan
+        zeroFreePatterns, patternIndices = np.unique(
+            totalConcs == 0, axis=0, return_inverse=True
+        )
+        for patternIndex, zeroFree in enumerate(zeroFreePatterns):
+            points = np.where(patternIndices.reshape(-1) == patternIndex)[0]
+            pattern = plan.getZeroPattern(zeroFree)
+            if pattern.allZero:
+                free[points] = totalConcs[points]
                 continue
-            zeroComplexes = zeroBound[~self.polymerIndices]
-            zeroPolymers = zeroBound[self.polymerIndices]
+            nonzeroFree = pattern.nonzeroFree
 
-            filteredKs = complexKs[~zeroComplexes]
-            filteredK2s = k2s[~zeroFree]
-            filteredKns = kns[~zeroFree]
-            filteredKabs = kabs[~zeroPolymers]
+            filteredKs = complexKs[pattern.complexFilter]
+            filteredK2s = k2s[nonzeroFree]
+            filteredKns = kns[nonzeroFree]
+            filteredKabs = kabs[pattern.polymerFilter]
 
-            filteredTotal = additionTotalConcs[~zeroFree]
-            filteredComplexM = self.complexStoichiometries[~zeroComplexes, :][
-                :, ~zeroFree
-            ]
-            filteredPolymerM = self.polymerStoichiometries[~zeroPolymers, :][
-                :, ~zeroFree
-            ]
+            filteredTotal = totalConcs[points][:, nonzeroFree]
+            filteredComplexM = pattern.complexStoichiometries
+            filteredPolymerM = pattern.polymerStoichiometries
 
-            args = (
+            logFree, converged = self.solveBatch(
                 filteredKs,
                 filteredK2s,
                 filteredKns,
@@ -734,83 +1435,42 @@ class SpeciationSolver(Speciation):
                 filteredTotal,
                 filteredComplexM,
                 filteredPolymerM,
+                None if warmStart is None else warmStart[points][:, nonzeroFree],
             )
+            logFree /= LN_10
+
+            # Fall back to L-BFGS-B for any points where Newton's method failed
+            for i in np.where(~converged)[0]:
+                args = (
+                    filteredKs,
+                    filteredK2s,
+                    filteredKns,
+                    filteredKabs,
+                    filteredTotal[i],
+                    filteredComplexM,
+                    filteredPolymerM,
+                )
 
-            lb = self.getLowerBounds(*args)
-            ub = self.getUpperBounds(*args)
-            if any(lb > ub):
-                # Correct for rounding errors. Unsure if this is necessary, as the only
-                # obvious case when it should happen is if no complexes are formed,
-                # which should be caught above.
-                mask = np.logical_and(lb > ub, np.isclose(lb, ub))
-                lb[mask], ub[mask] = ub[mask], lb[mask]
-
-            # TODO: deal with cases where lb and ub are very close together!
-            # self.scaling_factor = 1000 / min(ub - lb)
-            self.scaling_factor = 1000 / np.min(
-                np.abs(filteredTotal * np.log10(filteredTotal))
-            )
-            self.scaling_factor = 1
+                lb = self.getLowerBounds(*args)
+                ub = self.getUpperBounds(*args)
+                if any(lb > ub):
+                    # Correct for rounding errors. Unsure if this is necessary, as the
+                    # only obvious case when it should happen is if no complexes are
+                    # formed, which should be caught above.
+                    mask = np.logical_and(lb > ub, np.isclose(lb, ub))
+                    lb[mask], ub[mask] = ub[mask], lb[mask]
 
-            if i == 0:
-                # Initial guess: all species 100% free, only polymers are formed
-                x0 = ub
-            else:
-                # If the total concentration increased, the initial guess is that all
-                # the added molecules are free.
-                # If the total concentration decreased, the initial guess is that the
-                # free concentration decreases by the same fraction.
-                initialGuess = free[i - 1].copy()
-                difference = additionTotalConcs - totalConcs[i - 1]
-                concsIncreased = difference >= 0
-
-                initialGuess[concsIncreased] += difference[concsIncreased]
-                initialGuess[~concsIncreased] *= (
-                    totalConcs[i][~concsIncreased] / totalConcs[i - 1][~concsIncreased]
-                )
-                x0 = filteredTotal * np.log10(initialGuess[~zeroFree])
-                x0 = np.clip(x0, lb, ub)
+                x0 = np.clip(filteredTotal[i] * logFree[i], lb, ub)
+                if not np.all(np.isfinite(x0)):
+                    x0 = ub
+                logFree[i] = self.solveSingle(args, x0, lb, ub)
 
-            result = minimize(
-                self.objectiveScaled,
-                jac=self.jacobianScaled,
-                args=args,
-                x0=x0 * self.scaling_factor,
-                bounds=np.vstack([lb, ub]).T * self.scaling_factor,
-                method="L-BFGS-B",
-                options={
-                    "ftol": 0.0,
-                    "gtol": 1e-6 * LN_10,
-                },
-            )
-            if max(abs(result.jac)) > 1e-6 * LN_10:
-                self.scaling_factor *= 10_000
-                improvedResult = minimize(
-                    self.objectiveScaled,
-                    jac=self.jacobianScaled,
-                    args=args,
-                    x0=result.x,
-                    bounds=np.vstack([lb, ub]).T * self.scaling_factor,
-                    method="L-BFGS-B",
-                    options={
-                        "ftol": 0.0,
-                        "gtol": 1e-6 * LN_10,
-                    },
-                )
-                if max(abs(improvedResult.jac)) < max(abs(result.jac)):
-                    result = improvedResult
-                else:
-                    warnings.warn(
-                        "Desired accuracy not achieved in speciation",
-                        RuntimeWarning,
-                    )
+            free[np.ix_(points, nonzeroFree)] = 10**logFree
 
-            logFree = result.x / self.scaling_factor / filteredTotal
+        self.storeWarmStart(key, free)
 
-            free[i, ~zeroFree] = 10**logFree
-            free[i, zeroFree] = 0
-            # get the concentrations of the bound species from those of the free
-            bound[i] = self.freeToBoundConcs(free[i], complexKs, k2s, kns, kabs)
+        # get the concentrations of the bound species from those of the free
+        bound = self.freeToBoundConcs(free, complexKs, k2s, kns, kabs)
 
         return np.hstack([free, bound])
 
@@ -1,7 +1,14 @@
+import time
+from collections import OrderedDict
+
 import numpy as np
-from scipy.optimize import minimize
+from numpy import ma
 from scipy.signal import find_peaks
 
+from .diagnostics import timeStage
+from .modelPlan import ModelPlan
+from .optimiser import OptimiserNelderMead
+
 titrationAttributes = (
     "title",
     "rawData",
@@ -24,11 +31,105 @@ titrationAttributes = (
     "lastSignalVars",
     "lastFittedSpectra",
     "lastFittedCurves",
+    "fitConverged",
     "_selectedSignalTitles",
 )
 
+# Results of Titration.runStages stored by Titration.materialise as they are. The
+# fitted spectra and curves are converted to masked arrays first.
+fitStateAttributes = (
+    "lastKVars",
+    "lastTotalConcVars",
+    "lastKs",
+    "lastTotalConcs",
+    "lastSpeciesConcs",
+    "lastSignalVars",
+    "lastResiduals",
+)
+
+
+# Raised by a fit callback to stop the fit early, keeping the best parameters so far.
+class FitCancelled(Exception):
+    pass
+
+
+# Raised when a fit has used up the evaluations or time allowed by its Convergence.
+class FitBudgetExhausted(FitCancelled):
+    pass
+
+
+# Counts the evaluations and time spent by a fit, which starts when this is created.
+class FitBudget:
+    def __init__(self, convergence):
+        self.startTime = time.perf_counter()
+        self.evaluations = 0
+        self.maxEvaluations = convergence.maxEvaluations
+        self.maxTime = convergence.maxTime
+
+    @property
+    def elapsedTime(self):
+        return time.perf_counter() - self.startTime
+
+    # Raises FitBudgetExhausted if there is no budget left for the given number of
+    # evaluations.
+    def spend(self, evaluations=1):
+        if self.evaluations + evaluations > self.maxEvaluations:
+            raise FitBudgetExhausted
+        if self.elapsedTime > self.maxTime:
+            raise FitBudgetExhausted
+        self.evaluations += evaluations
+
 
 class Titration:
+    # Frozen ModelPlan, only set while a fit is running.
+    plan = None
+    # The lowest residual during the current fit, and the log10 of the parameters that
+    # gave it, only set while a fit is running.
+    bestFit = None
+    # Files saved before the optimiser could be selected have no optimiser set.
+    optimiser = None
+    # Set to a FitDiagnostics to record where the time is spent during a fit.
+    diagnostics = None
+    # Files saved before data compression was added don't compress the data.
+    dataCompression = None
+    # Files saved before the precision could be selected use double precision.
+    precision = None
+    # Files saved before the convergence criteria could be selected use the
+    # optimiser's defaults.
+    convergence = None
+    # FitBudget of the current fit, only set while a fit is running.
+    budget = None
+    # Whether the last fit converged, rather than being cancelled or stopped by its
+    # budget, or None for fits saved before this was recorded.
+    fitConverged = None
+    # Least recently used cache of the states returned by runStages, keyed on the log10
+    # parameters rounded to evaluationCacheDecimals, only set while a fit is running.
+    evaluationCache = None
+    evaluationCacheSize = 64
+    evaluationCacheDecimals = 12
+    # Each distinct minimum found by a global search, as (log10 parameters, residuals,
+    # times found), sorted by the residuals.
+    localMinima = None
+    # Relative difference between the residuals at the optimum in the precision used
+    # for the fit and in double precision, if the fit used a lower precision.
+    precisionError = None
+    # Why the chosen data compression wasn't used in the last fit, or None if it was.
+    compressionSkipped = None
+
+    # The state of a running fit isn't copied to the worker processes of a global
+    # search.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attribute in (
+            "plan",
+            "bestFit",
+            "diagnostics",
+            "evaluationCache",
+            "budget",
+        ):
+            state.pop(attribute, None)
+        return state
+
     def __init__(self, title="Titration"):
         self.title = title
         self.continuousRange = np.array([-np.inf, np.inf])
@@ -45,18 +146,80 @@ class Titration:
     def numSignals(self):
         return self.processedData.shape[1]
 
-    @property
-    def columnFilter(self):
+    # The column filter and processed data are cached, and only recomputed when
+    # rawData, signalTitles or continuousRange are changed. rawData and signalTitles
+    # are always replaced rather than modified in place, so they are compared by
+    # identity.
+    def getProcessedDataCache(self):
+        titles = self._signalTitles if self.hasSignalTitles else None
+        selection = (
+            self.continuous,
+            tuple(self.continuousRange) if self.continuous else None,
+        )
+        cache = self.__dict__.get("_processedDataCache")
+        if (
+            cache is not None
+            and cache["rawData"] is self.rawData
+            and cache["signalTitles"] is titles
+            and cache["selection"] == selection
+        ):
+            return cache
+
         if self.continuous:
             from_, to = self.continuousRange
-            return (self.signalTitles >= from_) & (self.signalTitles <= to)
-
+            columnFilter = (self.signalTitles >= from_) & (self.signalTitles <= to)
         else:
-            return slice(None)
+            columnFilter = slice(None)
+
+        processedData = self.rawData[:, columnFilter]
+        # Shared by every access, so mustn't be modified.
+        processedData.setflags(write=False)
+
+        cache = {
+            "rawData": self.rawData,
+            "signalTitles": titles,
+            "selection": selection,
+            "columnFilter": columnFilter,
+            "processedData": processedData,
+            "hasMissingDatapoints": bool(ma.is_masked(processedData)),
+        }
+        self._processedDataCache = cache
+        return cache
+
+    @property
+    def columnFilter(self):
+        return self.getProcessedDataCache()["columnFilter"]
 
     @property
     def processedData(self):
-        return self.rawData[:, self.columnFilter]
+        return self.getProcessedDataCache()["processedData"]
+
+    @property
+    def hasMissingDatapoints(self):
+        return self.getProcessedDataCache()["hasMissingDatapoints"]
+
+    # Floating point type of the data during a fit
+    @property
+    def fitDtype(self):
+        if self.precision is None:
+            return np.dtype(np.float64)
+        return np.dtype(self.precision.dtype)
+
+    # The absolute tolerance in log10 of each optimised parameter, or None to use the
+    # optimiser's defaults.
+    @property
+    def logTolerances(self):
+        if self.convergence is None:
+            return None
+        return self.convergence.getTolerances()
+
+    # Data the spectra are fitted to in the compressed space, only set while a fit is
+    # running with data compression.
+    @property
+    def compressedData(self):
+        if self.plan is None:
+            return None
+        return self.plan.compressedData
 
     @property
     def processedSignalTitles(self):
@@ -129,17 +292,24 @@ class Titration:
         else:
             return self.signalTitles.astype(str)
 
+    # Cached along with the processed data, as formatting every title is slow for
+    # continuous data.
     @property
     def processedSignalTitlesStrings(self):
-        if self.processedSignalTitles.dtype == float:
-            return np.array(
-                [
-                    f"{title:.{self.signalTitlesDecimals}f}"
-                    for title in self.processedSignalTitles
-                ]
-            )
-        else:
-            return self.processedSignalTitles.astype(str)
+        cache = self.getProcessedDataCache()
+        if "processedSignalTitlesStrings" not in cache:
+            if self.processedSignalTitles.dtype == float:
+                titles = np.array(
+                    [
+                        f"{title:.{self.signalTitlesDecimals}f}"
+                        for title in self.processedSignalTitles
+                    ]
+                )
+            else:
+                titles = self.processedSignalTitles.astype(str)
+            titles.setflags(write=False)
+            cache["processedSignalTitlesStrings"] = titles
+        return cache["processedSignalTitlesStrings"]
 
     @property
     def additionTitles(self):
@@ -250,59 +420,289 @@ class Titration:
         return largestPeakIndices[peaksRange >= np.max(peaksRange) * threshold]
 
     def optimisationFunc(self, ksAndTotalConcs):
+        return self.evaluate(ksAndTotalConcs)["lastResiduals"]
+
+    # Runs the model, returning the results by the name of the attribute they're
+    # stored in. Within a fit, only what is needed for the residuals is calculated.
+    # Outside of one, the full results, including the masked fitted curves, are
+    # stored in the last* attributes for display and saving.
+    def evaluate(self, ksAndTotalConcs):
+        if self.budget is not None and self.plan is not None:
+            self.budget.spend()
+        diagnostics = self.diagnostics
+        with timeStage(diagnostics, "optimisationFunc"):
+            state = self.runStages(ksAndTotalConcs, diagnostics)
+        if self.plan is None:
+            with timeStage(diagnostics, "materialise"):
+                self.materialise(state)
+        return state
+
+    def runStages(self, ksAndTotalConcs, diagnostics=None):
         # scipy.optimize optimizes everything as a single array, so split it
         kVars = ksAndTotalConcs[: self.equilibriumConstants.variableCount]
-        self.lastKVars = kVars
         totalConcVars = ksAndTotalConcs[self.equilibriumConstants.variableCount :]
-        self.lastTotalConcVars = totalConcVars
 
         # get all Ks and total concs, as some are fixed and thus aren't passed
         # to the function as arguments
-        speciationVars = self.equilibriumConstants.run(kVars)
-        self.lastKs = speciationVars
-        totalConcs = self.totalConcentrations.run(totalConcVars)
-        self.lastTotalConcs = totalConcs
+        with timeStage(diagnostics, "equilibriumConstants"):
+            speciationVars = self.equilibriumConstants.run(kVars)
+        with timeStage(diagnostics, "totalConcentrations"):
+            totalConcs = self.totalConcentrations.run(totalConcVars)
+
+        with timeStage(diagnostics, "speciation"):
+            speciesConcs = self.speciation.run(speciationVars, totalConcs)
+
+        with timeStage(diagnostics, "contributingSpecies"):
+            contributingSpeciesFilter = self.contributingSpecies.run()
+        with timeStage(diagnostics, "contributors"):
+            signalVars, contributorsCountPerMolecule = self.contributors.run(
+                speciesConcs
+            )
 
-        speciesConcs = self.speciation.run(speciationVars, totalConcs)
-        self.lastSpeciesConcs = speciesConcs
+        with timeStage(diagnostics, "proportionality"):
+            proportionalSignalVars = self.proportionality.run(
+                signalVars, contributorsCountPerMolecule
+            )
 
-        contributingSpeciesFilter = self.contributingSpecies.run()
-        signalVars, contributorsCountPerMolecule = self.contributors.run(speciesConcs)
-        self.lastSignalVars = signalVars
+        with timeStage(diagnostics, "knownSignals"):
+            knownSpectra = self.knownSignals.run()
 
-        proportionalSignalVars = self.proportionality.run(
-            signalVars, contributorsCountPerMolecule
+        with timeStage(diagnostics, "fitSignals"):
+            fittedSpectra, residuals = self.fitSignals.fit(
+                proportionalSignalVars, knownSpectra
+            )
+
+        # always accumulated in double precision
+        combinedResiduals = np.sqrt(np.sum(residuals, dtype=np.float64))
+
+        if self.bestFit is not None and combinedResiduals < self.bestFit[0]:
+            self.bestFit = (combinedResiduals, np.log10(ksAndTotalConcs))
+
+        return {
+            "lastKVars": kVars,
+            "lastTotalConcVars": totalConcVars,
+            "lastKs": speciationVars,
+            "lastTotalConcs": totalConcs,
+            "lastSpeciesConcs": speciesConcs,
+            "lastSignalVars": signalVars,
+            "lastFittedSpectra": fittedSpectra,
+            "lastResiduals": combinedResiduals,
+            # needed to calculate the fitted curves
+            "proportionalSignalVars": proportionalSignalVars,
+            "knownSpectra": knownSpectra,
+        }
+
+    # Stores the results of runStages, calculating the masked fitted spectra and
+    # curves.
+    def materialise(self, state):
+        for attribute in fitStateAttributes:
+            setattr(self, attribute, state[attribute])
+        self.lastFittedSpectra, self.lastFittedCurves = self.fitSignals.materialise(
+            state["lastFittedSpectra"],
+            state["proportionalSignalVars"],
+            state["knownSpectra"],
         )
 
-        knownSpectra = self.knownSignals.run()
+    # The combined residuals for each row of ksAndTotalConcsBatch, passing the whole
+    # population through each stage at once. Stages that can't be vectorised fall
+    # back to evaluating each member separately.
+    def optimisationFuncBatch(self, ksAndTotalConcsBatch):
+        diagnostics = self.diagnostics
+        ksAndTotalConcsBatch = np.atleast_2d(ksAndTotalConcsBatch)
+        if self.budget is not None:
+            self.budget.spend(len(ksAndTotalConcsBatch))
+        kCount = self.equilibriumConstants.variableCount
+        with timeStage(diagnostics, "optimisationFuncBatch"):
+            with timeStage(diagnostics, "batch.equilibriumConstants"):
+                speciationVars = self.equilibriumConstants.runBatch(
+                    ksAndTotalConcsBatch[:, :kCount]
+                )
+            with timeStage(diagnostics, "batch.totalConcentrations"):
+                totalConcs = self.totalConcentrations.runBatch(
+                    ksAndTotalConcsBatch[:, kCount:]
+                )
+            with timeStage(diagnostics, "batch.speciation"):
+                speciesConcs = self.speciation.runBatch(speciationVars, totalConcs)
+
+            # These only involve matrix products and broadcasting, so work on the
+            # whole population as they are.
+            with timeStage(diagnostics, "batch.contributors"):
+                signalVars, contributorsCountPerMolecule = self.contributors.run(
+                    speciesConcs
+                )
+            with timeStage(diagnostics, "batch.proportionality"):
+                proportionalSignalVars = self.proportionality.run(
+                    signalVars, contributorsCountPerMolecule
+                )
 
-        self.lastFittedSpectra, residuals, self.lastFittedCurves = self.fitSignals.run(
-            proportionalSignalVars, knownSpectra
-        )
+            with timeStage(diagnostics, "batch.fitSignals"):
+                residuals = self.fitSignals.fitBatch(
+                    proportionalSignalVars, self.knownSignals.run()
+                )
 
-        combinedResiduals = np.sqrt(np.sum(residuals))
-        self.lastResiduals = combinedResiduals
+            combinedResiduals = np.sqrt(np.sum(residuals, axis=1, dtype=np.float64))
+        if diagnostics is not None:
+            diagnostics.addSamples("batch.populationSize", len(ksAndTotalConcsBatch))
+
+        if self.bestFit is not None and len(combinedResiduals) > 0:
+            best = np.argmin(
+                np.where(np.isnan(combinedResiduals), np.inf, combinedResiduals)
+            )
+            if combinedResiduals[best] < self.bestFit[0]:
+                self.bestFit = (
+                    combinedResiduals[best],
+                    np.log10(ksAndTotalConcsBatch[best]),
+                )
 
         return combinedResiduals
 
+    def optimisationFuncLogBatch(self, logKsAndTotalConcsBatch):
+        ksAndTotalConcsBatch = 10 ** np.asarray(logKsAndTotalConcsBatch)
+        return self.optimisationFuncBatch(ksAndTotalConcsBatch)
+
+    # The same as evaluate, but taking log10 of the parameters, and reusing the state
+    # of any previous evaluation at the same point during the current fit.
+    def evaluateLog(self, logKsAndTotalConcs):
+        cache = self.evaluationCache
+        if cache is None:
+            return self.evaluate(10**logKsAndTotalConcs)
+
+        key = np.round(
+            np.asarray(logKsAndTotalConcs, dtype=float), self.evaluationCacheDecimals
+        ).tobytes()
+        state = cache.get(key)
+        if state is None:
+            if self.diagnostics is not None:
+                self.diagnostics.count("evaluationCache.misses")
+            state = self.evaluate(10**logKsAndTotalConcs)
+            cache[key] = state
+            while len(cache) > self.evaluationCacheSize:
+                cache.popitem(last=False)
+        else:
+            if self.diagnostics is not None:
+                self.diagnostics.count("evaluationCache.hits")
+            cache.move_to_end(key)
+            if self.plan is None:
+                with timeStage(self.diagnostics, "materialise"):
+                    self.materialise(state)
+        return state
+
     def optimisationFuncLog(self, logKsAndTotalConcs):
-        ksAndTotalConcs = 10**logKsAndTotalConcs
-        return self.optimisationFunc(ksAndTotalConcs)
+        return self.evaluateLog(logKsAndTotalConcs)["lastResiduals"]
+
+    # The vector of differences between the data and the fitted curves, with 0 for any
+    # missing datapoints, whose norm is returned by optimisationFunc. If the data is
+    # compressed, this excludes the constant discarded part of the data.
+    def optimisationResiduals(self, ksAndTotalConcs):
+        return self.residualVector(self.evaluate(ksAndTotalConcs))
+
+    def optimisationResidualsLog(self, logKsAndTotalConcs):
+        return self.residualVector(self.evaluateLog(logKsAndTotalConcs))
+
+    def residualVector(self, state):
+        residuals = self.fitSignals.residualVector(
+            ma.getdata(state["lastFittedSpectra"]),
+            state["proportionalSignalVars"],
+            state["knownSpectra"],
+        )
+        return residuals.ravel().astype(np.float64)
 
     def optimise(self, callback=None):
         initialGuessKs = np.log10(self.equilibriumConstants.variableInitialGuesses)
         initialGuessConcs = np.log10(self.totalConcentrations.variableInitialGuesses)
         initialGuess = np.concatenate((initialGuessKs, initialGuessConcs))
 
-        result = minimize(
-            self.optimisationFuncLog,
-            x0=initialGuess,
-            method="nelder-mead",
-            callback=callback,
-        )
-        # to make sure the last fit is the optimal one
-        self.optimisationFuncLog(result.x)
-        return result.x
+        optimiser = self.optimiser
+        if optimiser is None:
+            optimiser = OptimiserNelderMead(self)
+        if self.diagnostics is not None:
+            self.diagnostics.describeModel(self)
+
+        # The model can't change during the fit, so compile it once beforehand.
+        self.plan = ModelPlan(self)
+        if self.dataCompression is not None and self.compressedData is None:
+            self.compressionSkipped = self.dataCompression.skippedReason()
+        else:
+            self.compressionSkipped = None
+        if self.diagnostics is not None and self.compressionSkipped is not None:
+            self.diagnostics.record("dataCompression.skipped", self.compressionSkipped)
+        if self.diagnostics is not None and self.compressedData is not None:
+            self.diagnostics.record("dataCompression.rank", self.compressedData.rank)
+            self.diagnostics.record(
+                "dataCompression.discardedVarianceFraction",
+                self.compressedData.discardedVariance
+                / self.compressedData.totalVariance,
+            )
+        self.bestFit = (np.inf, initialGuess)
+        self.localMinima = None
+        self.evaluationCache = OrderedDict()
+        if self.convergence is not None:
+            self.budget = FitBudget(self.convergence)
+        # Optimisers may set this to False if they stop before converging.
+        self.fitConverged = True
+        try:
+            try:
+                try:
+                    with timeStage(self.diagnostics, "optimise"):
+                        optimum = optimiser.run(initialGuess, callback)
+                except FitCancelled as e:
+                    # the best parameters found before running out of budget or
+                    # being cancelled
+                    optimum = self.bestFit[1]
+                    self.fitConverged = False
+                    if self.diagnostics is not None:
+                        self.diagnostics.record(
+                            "stoppedBy",
+                            (
+                                "budget"
+                                if isinstance(e, FitBudgetExhausted)
+                                else "cancelled"
+                            ),
+                        )
+                finally:
+                    # The budget only limits the optimiser, not the evaluations at
+                    # the optimum below.
+                    if self.diagnostics is not None and self.budget is not None:
+                        self.diagnostics.record(
+                            "budget.evaluations", self.budget.evaluations
+                        )
+                    self.budget = None
+                # Only a diagnostic, so failing to calculate it mustn't lose the
+                # optimum.
+                reducedPrecisionResidual = None
+                if self.plan.dtype != np.float64:
+                    try:
+                        reducedPrecisionResidual = self.optimisationFuncLog(optimum)
+                    except Exception:
+                        pass
+                # The state at the optimum can only be reused for the final
+                # evaluation if it was calculated from the full data in double
+                # precision.
+                if self.plan.dtype != np.float64 or self.compressedData is not None:
+                    self.evaluationCache = None
+            finally:
+                self.plan = None
+                self.bestFit = None
+            # to make sure the last fit is the optimal one, and is of the full data in
+            # double precision
+            residual = self.optimisationFuncLog(optimum)
+        finally:
+            self.evaluationCache = None
+        if self.diagnostics is not None:
+            hits = self.diagnostics.counters.get("evaluationCache.hits", 0)
+            misses = self.diagnostics.counters.get("evaluationCache.misses", 0)
+            if hits + misses > 0:
+                self.diagnostics.record(
+                    "evaluationCache.hitRate", hits / (hits + misses)
+                )
+
+        if reducedPrecisionResidual is not None:
+            self.precisionError = abs(reducedPrecisionResidual - residual) / residual
+            if self.diagnostics is not None:
+                self.diagnostics.record("precisionError", self.precisionError)
+        else:
+            self.precisionError = None
+        return optimum
 
     def fitData(self, callback=None):
         self.fitResult = 10 ** self.optimise(callback)
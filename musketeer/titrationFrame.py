@@ -1,4 +1,7 @@
 import os
+import queue
+import threading
+import time
 import tkinter as tk
 import tkinter.filedialog as fd
 import tkinter.messagebox as mb
@@ -25,10 +28,15 @@ from . import (
     __version__,
     contributingSpecies,
     contributors,
+    convergence,
+    dataCompression,
+    diagnostics,
     editData,
     equilibriumConstants,
     fitSignals,
     knownSignals,
+    optimiser,
+    precision,
     proportionality,
     speciation,
     totalConcentrations,
@@ -38,7 +46,7 @@ from .patchMatplotlib import NavigationToolbarVertical, VerticalToolbarAxes
 from .scrolledFrame import ScrolledFrame
 from .style import defaultFigureParams, figureParams, padding
 from .table import Table, ButtonFrame
-from .titration import Titration, titrationAttributes
+from .titration import FitCancelled, Titration, titrationAttributes
 
 # Magic value indicating that the data in a .fit file should be copied from the original
 # titration
@@ -53,6 +61,10 @@ titrationModules = [
     contributors,
     knownSignals,
     fitSignals,
+    dataCompression,
+    precision,
+    convergence,
+    optimiser,
 ]
 
 
@@ -94,6 +106,15 @@ class TitrationFrame(ttk.Frame):
         )
         fitDataButton.grid(sticky="nesw", pady=padding, ipady=padding)
 
+        self.recordDiagnostics = tk.BooleanVar(self, value=False)
+        recordDiagnosticsButton = ttk.Checkbutton(
+            self.options,
+            text="Record fit diagnostics",
+            variable=self.recordDiagnostics,
+            style="Outline.Toolbutton",
+        )
+        recordDiagnosticsButton.grid(sticky="nesw", pady=padding)
+
         separator = ttk.Separator(self.options, orient="horizontal")
         separator.grid(sticky="nesw", pady=padding)
 
@@ -370,7 +391,7 @@ class TitrationFrame(ttk.Frame):
             moduleFrame.update(fitNotebook.titration)
 
     def fitData(self):
-        self.currentTab.fitData()
+        self.currentTab.fitData(self.recordDiagnostics.get())
 
     def saveFile(self, saveAs=False):
         options = {}
@@ -382,6 +403,9 @@ class TitrationFrame(ttk.Frame):
                 data = getattr(self.originalTitration, titrationAttribute)
             except AttributeError:
                 continue
+            # None can't be saved without pickling, and is the default when loading.
+            if data is None:
+                continue
 
             if isinstance(data, ma.MaskedArray):
                 options[f".original.{titrationAttribute}"] = data.data
@@ -410,6 +434,8 @@ class TitrationFrame(ttk.Frame):
                     data = getattr(titration, titrationAttribute)
                 except AttributeError:
                     continue
+                if data is None:
+                    continue
 
                 if isinstance(data, ma.MaskedArray):
                     options[f"{fit}.{titrationAttribute}"] = data.data
@@ -495,21 +521,77 @@ class FitNotebook(ttk.Notebook):
             except Exception as e:
                 print("Warning: failed to load previous fit result:", e)
 
-    def fitData(self):
+    # Minimum time between progress updates during a fit, in seconds
+    progressInterval = 0.2
+
+    # The fit runs in a separate thread, which mustn't access any Tk widgets, and
+    # reports back through progressQueue. The main window stays busy until the fit
+    # has finished, so that the titration can't be modified while it runs.
+    def fitData(self, recordDiagnostics=False):
+        self.titration.diagnostics = (
+            diagnostics.FitDiagnostics() if recordDiagnostics else None
+        )
+
         self.tk.eval("tk busy .")
-        self.update()
+        self.cancelEvent = threading.Event()
+        self.progressQueue = queue.Queue()
+        self.fitIteration = 0
+        self.fitStartTime = self.lastProgressTime = time.perf_counter()
+
+        root = self.winfo_toplevel()
+        self.progressPopup = FitProgressPopup(root, self.cancelFit)
+        self.progressPopup.geometry(f"+{root.winfo_x()+100}+{root.winfo_y()+100}")
+
+        threading.Thread(target=self.fitWorker, daemon=True).start()
+        self.after(int(self.progressInterval * 1000), self.checkFit)
+
+    def fitWorker(self):
         try:
             self.titration.fitData(self.fitCallback)
         except Exception as e:
-            mb.showerror(title="Failed to fit data", message=e, parent=self)
-            return
-        finally:
-            self.tk.eval("tk busy forget .")
-            self.update()
-        self.showFit()
+            self.progressQueue.put(("error", e))
+        else:
+            self.progressQueue.put(("finished",))
 
+    # Called from the fitting thread
     def fitCallback(self, *args):
-        self.update()
+        if self.cancelEvent.is_set():
+            raise FitCancelled
+        self.fitIteration += 1
+        currentTime = time.perf_counter()
+        if currentTime - self.lastProgressTime >= self.progressInterval:
+            self.lastProgressTime = currentTime
+            self.progressQueue.put(
+                (
+                    "progress",
+                    self.fitIteration,
+                    self.titration.bestFit[0],
+                    currentTime - self.fitStartTime,
+                )
+            )
+
+    def cancelFit(self):
+        self.cancelEvent.set()
+        self.progressPopup.cancelling()
+
+    def checkFit(self):
+        while True:
+            try:
+                message, *args = self.progressQueue.get_nowait()
+            except queue.Empty:
+                self.after(int(self.progressInterval * 1000), self.checkFit)
+                return
+            if message == "progress":
+                self.progressPopup.showProgress(*args)
+            else:
+                break
+
+        self.progressPopup.destroy()
+        self.tk.eval("tk busy forget .")
+        if message == "error":
+            mb.showerror(title="Failed to fit data", message=args[0], parent=self)
+            return
+        self.showFit()
 
     def showFit(self):
         if hasattr(self.titration, "fitResult"):
@@ -543,6 +625,10 @@ class FitNotebook(ttk.Notebook):
         self.resultsFrame = ResultsFrame(self, self.titration)
         self.add(self.resultsFrame, text="Results")
 
+        if self.titration.diagnostics is not None:
+            self.diagnosticsFrame = DiagnosticsFrame(self, self.titration.diagnostics)
+            self.add(self.diagnosticsFrame, text="Diagnostics")
+
         if lastTabClass is not None:
             for tab in self.tabs():
                 widget = self.nametowidget(tab)
@@ -558,6 +644,37 @@ class FitNotebook(ttk.Notebook):
                 plotFrame.updateDpi()
 
 
+class FitProgressPopup(tk.Toplevel):
+    def __init__(self, master, cancel, *args, **kwargs):
+        super().__init__(master, padx=padding, pady=padding, *args, **kwargs)
+        self.title("Fitting")
+        self.resizable(False, False)
+        self.protocol("WM_DELETE_WINDOW", cancel)
+
+        self.progressLabel = ttk.Label(
+            self, text="Starting fit...", justify="left", width=30
+        )
+        self.progressLabel.pack(fill="x", padx=padding, pady=padding)
+
+        self.cancelButton = ttk.Button(
+            self, text="Cancel", command=cancel, style="danger.TButton"
+        )
+        self.cancelButton.pack(padx=padding, pady=padding)
+        self.transient(master)
+
+    def showProgress(self, iteration, residual, elapsedTime):
+        self.progressLabel.configure(
+            text=(
+                f"Iteration: {iteration}\n"
+                f"Residual: {residual:.4g}\n"
+                f"Elapsed time: {elapsedTime:.1f} s"
+            )
+        )
+
+    def cancelling(self):
+        self.cancelButton.configure(text="Cancelling...", state="disabled")
+
+
 class PlotFrame(ttk.Frame):
     @property
     def dpi(self):
@@ -1626,6 +1743,33 @@ class ResultsFrame(ttk.Frame):
         )
         rmselabel.pack(side="top", pady=15)
 
+        if titration.precisionError is not None:
+            precisionLabel = ttk.Label(
+                self,
+                text=(
+                    "Relative difference in the residuals at the optimum from double"
+                    f" precision: {titration.precisionError:.3g}"
+                ),
+            )
+            precisionLabel.pack(side="top")
+
+        if titration.compressionSkipped is not None:
+            compressionLabel = ttk.Label(
+                self,
+                text=f"The data wasn't compressed, as {titration.compressionSkipped}.",
+            )
+            compressionLabel.pack(side="top")
+
+        if titration.fitConverged is False:
+            convergenceLabel = ttk.Label(
+                self,
+                text=(
+                    "The fit was stopped before converging. These are the best"
+                    " parameters found."
+                ),
+            )
+            convergenceLabel.pack(side="top")
+
         kTable = Table(
             self,
             0,
@@ -1644,6 +1788,33 @@ class ResultsFrame(ttk.Frame):
             kTable.addRow(name, [self.formatK(value)])
         kTable.pack(side="top", pady=15)
 
+        if titration.localMinima is not None and len(titration.localMinima) > 1:
+            kCount = titration.equilibriumConstants.variableCount
+            minimaTable = Table(
+                self,
+                0,
+                0,
+                [
+                    *titration.equilibriumConstants.variableNames,
+                    "Residuals",
+                    "Times found",
+                ],
+                rowOptions=("readonlyTitles",),
+                columnOptions=("readonlyTitles",),
+            )
+            for index, (logParameters, residuals, timesFound) in enumerate(
+                titration.localMinima
+            ):
+                minimaTable.addRow(
+                    f"Minimum {index + 1}",
+                    [
+                        *(self.formatK(k) for k in 10 ** logParameters[:kCount]),
+                        f"{residuals:.{self.sigfigs}g}",
+                        timesFound,
+                    ],
+                )
+            minimaTable.pack(side="top", pady=15)
+
         # TODO: fix sheet becoming too small to be visible when there are a lot of
         # variables shown above it.
 
@@ -1711,3 +1882,92 @@ class ResultsFrame(ttk.Frame):
             np.savetxt(fileName, output, fmt="%s", delimiter=",", encoding="utf-8-sig")
         except Exception as e:
             mb.showerror(title="Could not save file", message=e, parent=self)
+
+
+class DiagnosticsFrame(ttk.Frame):
+    def __init__(self, parent, diagnostics, *args, **kwargs):
+        super().__init__(parent, *args, **kwargs)
+        self.diagnostics = diagnostics
+        self.showDiagnostics()
+
+    def addSheet(self, data, headers, rowIndex):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            sheet = tksheet.Sheet(
+                self,
+                empty_vertical=0,
+                empty_horizontal=0,
+                data=data,
+                headers=headers,
+                row_index=rowIndex,
+                set_all_heights_and_widths=True,
+            )
+        sheet.MT.configure(height=0)
+        sheet.RI.configure(height=0)
+        sheet.enable_bindings()
+        sheet.set_width_of_index_to_text()
+        sheet.pack(side="top", pady=15, fill="both", expand=True)
+
+    def showDiagnostics(self):
+        summary = self.diagnostics.summary()
+
+        stages = summary["stages"]
+        timeHeaders = ["mean", *(f"p{q}" for q in diagnostics.percentiles)]
+        self.addSheet(
+            [
+                [stage["calls"], f"{stage['total']:.4g}"]
+                + [f"{stage[header] * 1000:.4g}" for header in timeHeaders]
+                for stage in stages.values()
+            ],
+            ["Calls", "Total (s)"]
+            + [f"{header.capitalize()} (ms)" for header in timeHeaders],
+            list(stages.keys()),
+        )
+
+        samples = summary["samples"]
+        counters = summary["counters"]
+        sampleHeaders = ["mean", "max", *(f"p{q}" for q in diagnostics.percentiles)]
+        self.addSheet(
+            [
+                [values["count"]]
+                + [f"{values[header]:.4g}" for header in sampleHeaders]
+                for values in samples.values()
+            ]
+            + [[count] + [""] * len(sampleHeaders) for count in counters.values()],
+            ["Count"] + [header.capitalize() for header in sampleHeaders],
+            list(samples.keys()) + list(counters.keys()),
+        )
+
+        values = summary["values"]
+        model = summary["model"]
+        self.addSheet(
+            [
+                [f"{value:.4g}" if isinstance(value, float) else value]
+                for value in values.values()
+            ]
+            + [[strategy] for strategy in model.values()],
+            ["Value"],
+            list(values.keys()) + list(model.keys()),
+        )
+
+        saveButton = ttk.Button(
+            self,
+            text="Export diagnostics to JSON",
+            command=self.saveJson,
+            style="success.TButton",
+        )
+        saveButton.pack(side="top", pady=15)
+
+    def saveJson(self):
+        fileName = fd.asksaveasfilename(
+            title="Export diagnostics",
+            initialfile="fit_diagnostics",
+            filetypes=[("JSON file", "*.json")],
+            defaultextension=".json",
+        )
+        if not fileName:
+            return
+        try:
+            self.diagnostics.saveJson(fileName)
+        except Exception as e:
+            mb.showerror(title="Could not save file", message=e, parent=self)
@@ -61,6 +61,17 @@ class totalConcentrations(moduleFrame.Strategy):
     def run(self, totalConcVars):
         pass
 
+    # The output of run for each row of totalConcVarsBatch
+    def runBatch(self, totalConcVarsBatch):
+        if self.variableCount == 0:
+            totalConcs = self.run(np.empty(0))
+            return np.broadcast_to(
+                totalConcs, (len(totalConcVarsBatch),) + totalConcs.shape
+            )
+        return np.array(
+            [self.run(totalConcVars) for totalConcVars in totalConcVarsBatch]
+        )
+
 
 class StockTable(Table):
     def __init__(self, master, titration):
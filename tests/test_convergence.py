@@ -0,0 +1,86 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from numpy import ma
+
+from musketeer import convergence, optimiser, precision
+from musketeer.titration import Titration, titrationAttributes
+from musketeer.titrationFrame import COPY_ORIGINAL_ARRAY, titrationModules
+
+examplePath = Path(__file__).parent.parent / "examples" / "UV-Vis_example.fit"
+
+
+def loadArray(file, key):
+    data = file[key]
+    if data.shape == ():
+        data = data.item()
+    try:
+        mask = file[f"{key}.mask"]
+    except KeyError:
+        return data
+    return ma.masked_array(data, mask.item() if mask.shape == () else mask)
+
+
+# The first fit in a .fit file, loaded the same way as by TitrationFrame.
+def loadExample():
+    file = np.load(examplePath, allow_pickle=False)
+    name = file[".fits"][0]
+    titration = Titration()
+    for attribute in titrationAttributes:
+        try:
+            data = loadArray(file, f"{name}.{attribute}")
+        except KeyError:
+            continue
+        if isinstance(data, str) and data == COPY_ORIGINAL_ARRAY:
+            data = loadArray(file, f".original.{attribute}")
+        setattr(titration, attribute, data)
+
+    for module in titrationModules:
+        moduleFrame = module.ModuleFrame
+        setattr(titration, moduleFrame.attributeName, None)
+        try:
+            key = file[f"{name}.{moduleFrame.attributeName}"].item()
+        except KeyError:
+            continue
+        strategy = moduleFrame.dropdownOptions[key](titration)
+        for attribute in strategy.popupAttributes:
+            key = f"{name}.{moduleFrame.attributeName}.{attribute}"
+            try:
+                data = loadArray(file, key)
+            except KeyError:
+                # the example predates the initial guesses for unknown
+                # concentrations
+                if not attribute.endswith("Guesses"):
+                    continue
+                data = ma.masked_all_like(loadArray(file, key[: -len("Guesses")]))
+            setattr(strategy, attribute, data)
+        setattr(titration, moduleFrame.attributeName, strategy)
+    return titration
+
+
+# The evaluations at the optimum after the fit, including the one in reduced precision,
+# must not be limited by the budget, which would discard the best parameters found.
+@pytest.mark.parametrize(
+    "Optimiser, limits",
+    [
+        (optimiser.OptimiserDifferentialEvolution, {"maxEvaluations": 90}),
+        (optimiser.OptimiserMultiStart, {"maxTime": 0.5}),
+    ],
+)
+def test_budget_with_single_precision(Optimiser, limits):
+    titration = loadExample()
+    titration.optimiser = Optimiser(titration)
+    titration.optimiser.startCount = 8
+    titration.precision = precision.PrecisionSingle(titration)
+    titration.convergence = convergence.ConvergenceCustom(titration)
+    for attribute, value in limits.items():
+        setattr(titration.convergence, attribute, value)
+
+    titration.fitData()
+
+    assert titration.fitConverged is False
+    assert titration.budget is None
+    assert np.all(np.isfinite(titration.fitResult))
+    assert np.isfinite(titration.lastResiduals)
+    assert titration.precisionError is not None